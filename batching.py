@@ -0,0 +1,59 @@
+"""
+Sizes translation batches by estimated tokens instead of a fixed line count.
+
+A batch costs its input tokens plus the output tokens expected for it. The
+budget per request starts at the model limit, is halved when a reply gets
+truncated (or the request fails or takes too long), and grows back slowly
+after clean replies.
+"""
+
+from typing import List
+
+from ratelimit import estimate_tokens
+
+
+class BatchSizer:
+    def __init__(self, max_lines: int, max_tokens: int, output_ratio: float = 1.5, target_latency: float = 0,
+                 min_tokens: int = 256):
+        self.max_lines = max(max_lines, 1)
+        self.max_tokens = max_tokens
+        self.min_tokens = min(min_tokens, max_tokens)
+        self.budget = float(max_tokens)
+        # expected output tokens per input token, refined from the replies
+        self.output_ratio = output_ratio
+        self.target_latency = target_latency
+        self.last_cost = 0.0
+        self.last_reserved = 0
+
+    def take(self, texts: List[str], reserved: int = 0) -> int:
+        """Returns how many of the leading texts fit into the next batch (at least one).
+
+        `reserved` tokens of the budget are taken by the rest of the prompt, e.g. the history.
+        """
+        n = 0
+        cost = 0.0
+        for t in texts[:self.max_lines]:
+            c = estimate_tokens(t) * (1 + self.output_ratio)
+            if n > 0 and reserved + cost + c > self.budget:
+                break
+            cost += c
+            n += 1
+        self.last_cost = cost
+        self.last_reserved = reserved
+        return n
+
+    def shrink(self):
+        batch = min(self.budget - self.last_reserved, self.last_cost)
+        self.budget = max(self.min_tokens, self.last_reserved + batch / 2)
+
+    def grow(self):
+        self.budget = min(self.max_tokens, self.budget * 1.25)
+
+    def observe(self, latency: float, truncated: bool, source: str = "", output: str = ""):
+        if source and output:
+            ratio = estimate_tokens(output) / estimate_tokens(source)
+            self.output_ratio = 0.8 * self.output_ratio + 0.2 * ratio
+        if truncated or (self.target_latency and latency > self.target_latency):
+            self.shrink()
+        else:
+            self.grow()
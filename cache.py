@@ -0,0 +1,127 @@
+"""
+Caches shared by all runs of the scripts, kept in ~/.cache/kestrel by default.
+Set KESTREL_CACHE_DIR to put them elsewhere.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+def cache_dir() -> str:
+    path = os.environ.get("KESTREL_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "kestrel")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class UploadCache:
+    """Maps the content hash of an uploaded file to its remote file name.
+
+    Google deletes uploaded files after 48 hours, so every entry carries the
+    expiration time reported by the API and expired entries are evicted.
+    """
+
+    # do not hand out files that expire before the transcription is done
+    margin = 3600
+
+    def __init__(self, path: Optional[str] = None):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path or os.path.join(cache_dir(), "uploads.db"), check_same_thread=False)
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS uploads (
+                digest TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                expires REAL NOT NULL
+            )""")
+            self.conn.execute("DELETE FROM uploads WHERE expires < ?", (time.time() + self.margin,))
+
+    def lookup(self, digest: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT name FROM uploads WHERE digest=? AND expires>=?",
+                                    (digest, time.time() + self.margin)).fetchone()
+        return None if row is None else row[0]
+
+    def store(self, digest: str, name: str, expires: float):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO uploads (digest, name, expires) VALUES (?, ?, ?)", (digest, name, expires))
+
+    def forget(self, digest: str):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM uploads WHERE digest=?", (digest,))
+
+    def close(self):
+        self.conn.close()
+
+
+class ResponseCache:
+    """Persistent, size-bounded LRU cache of model responses.
+
+    Keys are hashes of everything that determines a response: the model, the
+    system instruction, the prompt contents and the generation config.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_bytes: int = 512 * 1024 * 1024):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path or os.path.join(cache_dir(), "responses.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                used REAL NOT NULL
+            )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self.total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, system_instruction: str, contents, config=None) -> str:
+        blob = json.dumps([model, system_instruction, contents, config], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT value FROM responses WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET used=? WHERE key=?", (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, value: str):
+        size = len(value.encode("utf-8"))
+        with self.lock, self.conn:
+            old = self.conn.execute("SELECT size FROM responses WHERE key=?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, value, size, used) VALUES (?, ?, ?, ?)",
+                              (key, value, size, time.time()))
+            self.total += size - (old[0] if old else 0)
+            if self.total > self.max_bytes:
+                for victim, victim_size in self.conn.execute("SELECT key, size FROM responses WHERE key!=? ORDER BY used LIMIT 64", (key,)).fetchall():
+                    if self.total <= self.max_bytes:
+                        break
+                    self.conn.execute("DELETE FROM responses WHERE key=?", (victim,))
+                    self.total -= victim_size
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f"Response cache: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate)"
+
+    def close(self):
+        self.conn.close()
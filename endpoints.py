@@ -0,0 +1,135 @@
+"""
+A pool of Ollama or OpenAI-compatible servers sharing one translation job.
+
+Every endpoint serves at most `limit` requests at the same time, and each
+request goes to the healthy endpoint with the lowest load. An endpoint whose
+request fails is taken out of rotation until a periodic health check (listing
+the models of the server) finds it up again. Once every endpoint is down,
+they are checked right away, and the translation fails if none is up.
+"""
+
+import asyncio
+from typing import List, Optional, Tuple
+
+
+def parse_endpoint(spec: str, default_limit: int = 1) -> Tuple[str, int]:
+    # "http://host:11434" or "http://host:11434=2" to serve 2 requests at a time
+    url, sep, limit = spec.rpartition("=")
+    if sep and limit.isdigit():
+        return url, int(limit)
+    return spec, default_limit
+
+
+class Endpoint:
+    def __init__(self, api: str, url: str, limit: int = 1):
+        self.api = api
+        self.url = url
+        self.limit = max(limit, 1)
+        self.inflight = 0
+        self.healthy = True
+        self.served = 0
+        self.failures = 0
+        if api == "ollama":
+            import ollama
+            self.client = ollama.AsyncClient(host=url)
+        elif api == "openai":
+            from openai import AsyncOpenAI
+            self.client = AsyncOpenAI(base_url=url, api_key="ollama")  # required but ignored
+        else:
+            raise ValueError("Unsupported API. Use --api to specify either 'ollama' or 'openai'.")
+
+    def load(self) -> float:
+        return self.inflight / self.limit
+
+    async def check(self, timeout: float = 10) -> bool:
+        try:
+            if self.api == "ollama":
+                await asyncio.wait_for(self.client.list(), timeout)
+            else:
+                await asyncio.wait_for(self.client.models.list(), timeout)
+            if not self.healthy:
+                print(f"Endpoint {self.url} is back")
+            self.healthy = True
+        except Exception as e:
+            if self.healthy:
+                print(f"Endpoint {self.url} is down: {e}")
+            self.healthy = False
+        return self.healthy
+
+    async def chat(self, model: str, messages, schema) -> str:
+        if self.api == "ollama":
+            response = await self.client.chat(model, messages=messages, options={'think': False}, format=schema, think=False)
+            self.served += 1
+            return response.message.content
+        completion = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            extra_body={"enable_thinking": False},
+            response_format={"type": "json_object", "schema": schema}
+        )
+        self.served += 1
+        return completion.choices[0].message.content
+
+
+class EndpointPool:
+    def __init__(self, endpoints: List[Endpoint], check_interval: float = 30):
+        self.endpoints = endpoints
+        self.check_interval = check_interval
+        self.changed: Optional[asyncio.Condition] = None
+        self.checker: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # must run inside the event loop that uses the pool
+        self.changed = asyncio.Condition()
+        await self.check_all()
+        self.checker = asyncio.create_task(self.check_loop())
+
+    async def check_all(self):
+        await asyncio.gather(*(e.check() for e in self.endpoints))
+        if not any(e.healthy for e in self.endpoints):
+            raise RuntimeError("None of the endpoints is reachable: " + ", ".join(e.url for e in self.endpoints))
+
+    async def check_loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            down = [e for e in self.endpoints if not e.healthy]
+            if down:
+                await asyncio.gather(*(e.check() for e in down))
+                async with self.changed:
+                    self.changed.notify_all()
+
+    async def close(self):
+        if self.checker is not None:
+            self.checker.cancel()
+            self.checker = None
+
+    def pick(self) -> Optional[Endpoint]:
+        free = [e for e in self.endpoints if e.healthy and e.inflight < e.limit]
+        return min(free, key=Endpoint.load) if free else None
+
+    async def acquire(self) -> Endpoint:
+        """Waits for a free slot on the least loaded healthy endpoint and takes it.
+
+        Raises RuntimeError if every endpoint is down and still fails a health check."""
+        async with self.changed:
+            while True:
+                if not any(e.healthy for e in self.endpoints):
+                    # nothing would wake us up until the next periodic check
+                    await self.check_all()
+                endpoint = self.pick()
+                if endpoint is not None:
+                    break
+                await self.changed.wait()
+            endpoint.inflight += 1
+        return endpoint
+
+    async def release(self, endpoint: Endpoint, failed: bool = False):
+        async with self.changed:
+            endpoint.inflight -= 1
+            if failed:
+                endpoint.failures += 1
+                endpoint.healthy = False
+            self.changed.notify_all()
+
+    def stats(self) -> str:
+        return "\n".join(f"{e.url}: {e.served} requests, {e.failures} failures" for e in self.endpoints)
@@ -0,0 +1,94 @@
+"""
+Request pacing shared by the Gemini scripts.
+
+RateLimiter keeps a requests-per-minute and a tokens-per-minute token bucket
+and blocks callers until both have room. On errors, backoff() sleeps with
+exponential backoff and jitter; quota errors (429) also pause every caller
+sharing the limiter, so a worker pool does not keep hammering the API.
+"""
+
+import random
+import threading
+import time
+
+
+def estimate_tokens(text: str) -> int:
+    # about one token per CJK character and per 3~4 ASCII characters
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+def error_status(e: Exception) -> int:
+    # the HTTP status given by the SDK, 0 if unknown. Digits in the message (a token
+    # count, a file name) are not taken for a status
+    for attr in ("code", "status_code"):
+        code = getattr(e, attr, None)
+        if isinstance(code, int):
+            return code
+    msg = str(e)
+    if "Resource has been exhausted" in msg or "RESOURCE_EXHAUSTED" in msg:
+        return 429
+    return 0
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.stamp = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, amount: float) -> float:
+        # a single request larger than the bucket only has to wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, rpm: float = 0, tpm: float = 0, base_delay: float = 5, max_delay: float = 120):
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    wait = 0.0
+                    if self.requests:
+                        self.requests.refill(now)
+                        wait = max(wait, self.requests.wait_time(1))
+                    if self.tokens:
+                        self.tokens.refill(now)
+                        wait = max(wait, self.tokens.wait_time(tokens))
+                    if wait <= 0:
+                        if self.requests:
+                            self.requests.level -= 1
+                        if self.tokens:
+                            self.tokens.level -= tokens
+                        return
+            time.sleep(wait)
+
+    def record_usage(self, estimated: int, actual: int):
+        # correct the token bucket once the real usage of a request is known
+        if self.tokens and actual:
+            with self.lock:
+                self.tokens.level -= actual - estimated
+
+    def backoff(self, attempt: int, error: Exception = None):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        if error is not None and error_status(error) == 429:
+            with self.lock:
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        time.sleep(delay)
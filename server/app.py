@@ -1,25 +1,50 @@
 import argparse
-from flask import Flask, render_template, request, jsonify, make_response
+import asyncio
+import atexit
+import glob
+from flask import Flask, render_template, request, jsonify, make_response, Response
 import subprocess
+import json
 import os
-import threading
 import re
+import sys
+import threading
+import time
 import unicodedata
+import jobs
+from job_store import JobStore
+
+# the scripts of Kestrel are in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import endpoints
+import ratelimit
+import transcribe_subsai
+import translate
+import translate_ollama
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--api-key', type=str, required=True, help='Google Gemini API Key')
 parser.add_argument('--path-env', type=str, required=True, help='Path enviroment variable')
 parser.add_argument('--proxy', type=str, default="http://127.0.0.1:8010", help='Proxy for API requests')
+parser.add_argument('--gpu-workers', type=int, default=1, help='Number of transcriptions run at the same time')
+parser.add_argument('--api-workers', type=int, default=2, help='Number of translations run at the same time')
+parser.add_argument('--download-workers', type=int, default=1, help='Number of downloads run at the same time')
+parser.add_argument('--download-dir', type=str, default=r"C:\shared", help='Directory of the downloaded videos')
+parser.add_argument('--jobs-db', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.db'), help='SQLite database of the jobs, kept across restarts')
+parser.add_argument('--whisper-port', type=int, default=6011, help='Local port of the resident whisper worker')
+parser.add_argument('--whisper-device', type=str, default='cuda', choices=['cuda', 'cpu'], help='Device of the whisper model')
+parser.add_argument('--whisper-compute-type', type=str, default=None, help='Compute type of the whisper model, float16 on cuda and int8 on cpu by default')
+parser.add_argument('--whisper-batched', action='store_true', help='Use the batched inference of faster-whisper')
+parser.add_argument('--translate-api', type=str, default='gemini', choices=['gemini', 'ollama', 'openai'], help='Translate with Gemini (translate.py) or with local models (translate_ollama.py)')
+parser.add_argument('--local-endpoints', nargs='+', default=None, help='URLs of the Ollama/OpenAI-compatible servers, optionally as URL=N')
+parser.add_argument('--local-model', type=str, default='gpt-oss:20b', help='Model of the local servers')
+parser.add_argument('--whisper-cpu-workers', type=int, default=0, help='Transcribe the VAD chunks of a video in this many CPU processes')
 args, unknown = parser.parse_known_args()
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
 
-process_info = {
-    'proc': None,
-    'step': None,
-    'log': []
-}
+job_queue = jobs.JobQueue({'gpu': args.gpu_workers, 'api': args.api_workers, 'download': args.download_workers}, JobStore(args.jobs_db))
 
 def sanitize_filename(name: str) -> str:
     """
@@ -43,50 +68,201 @@ def sanitize_filename(name: str) -> str:
 
     return name
 
-def run_task(video_path, api_key, batchsize, hint, output_file):
+def path_env():
+    envr = os.environ.copy()
+    envr["PATH"] = args.path_env + os.pathsep + envr.get("PATH", "")
+    return envr
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+def limiter_for(key):
+    # the translations using the same API key share its quota
+    with limiters_lock:
+        if key not in limiters:
+            limiters[key] = ratelimit.RateLimiter(5, 0)
+        return limiters[key]
+
+whisper_lock = threading.Lock()
+whisper_proc = None
+
+def whisper_worker(job):
+    """Starts the resident whisper worker on the first transcription, so the model is loaded once per server."""
+    global whisper_proc
+    with whisper_lock:
+        if whisper_proc is not None and whisper_proc.poll() is None:
+            return
+        # a worker left running by a previous server keeps its model loaded
+        if transcribe_subsai.ping(args.whisper_port):
+            return
+        job.append_log('[转录] 正在启动转录进程并加载模型...\n')
+        options = ['--device', args.whisper_device, '--cpu-workers', str(args.whisper_cpu_workers)]
+        if args.whisper_compute_type:
+            options += ['--compute-type', args.whisper_compute_type]
+        if args.whisper_batched:
+            options.append('--batched')
+        whisper_proc = transcribe_subsai.start_worker(args.whisper_port, options, env=path_env())
+        atexit.register(whisper_proc.terminate)
+
+def transcribe_step(video_path):
     base_dir = os.path.dirname(video_path)
     filename = os.path.splitext(os.path.basename(video_path))[0]
     video_ext = os.path.splitext(video_path)[1][1:] if '.' in os.path.basename(video_path) else 'mp4'
-    process_info['log'] = []
-    # Step 1: transcribe_subsai.py，传递参数
-    cmd1 = [
-        'python', '-u', 'transcribe_subsai.py',
-        '--base', base_dir,
-        '--files', filename,
-        '--video_ext', video_ext
-    ]
-    process_info['step'] = 'transcribe'
-    envr = os.environ.copy()
-    envr["PATH"] = args.path_env + os.pathsep + envr.get("PATH", "")
-    proc1 = subprocess.Popen(cmd1, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, universal_newlines=True, env=envr, encoding='utf-8')
-    process_info['proc'] = proc1
-    for line in proc1.stdout:
-        process_info['log'].append('[转录] ' + line)
-    proc1.wait()
-    process_info['proc'] = None
-    api_key = api_key if api_key else args.api_key
-    envr = os.environ.copy()
-    envr["HTTP_PROXY"] = args.proxy
-    envr["HTTPS_PROXY"] = args.proxy
-    envr['http_proxy'] = args.proxy
-    envr['https_proxy'] = args.proxy
-    # Step 2: translate.py
-    cmd2 = [
-        'python', '-u', 'translate.py',
-        '--base', base_dir,
-        '--key', api_key,
-        '--batchsize', str(batchsize),
-        '-l', filename,
-        '--hint', hint
-    ]
-    process_info['step'] = 'translate'
-    proc2 = subprocess.Popen(cmd2, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, universal_newlines=True, env=envr, encoding='utf-8')
-    process_info['proc'] = proc2
-    for line in proc2.stdout:
-        process_info['log'].append('[翻译] ' + line)
-    proc2.wait()
-    process_info['proc'] = None
-    process_info['step'] = None
+
+    def run(job):
+        whisper_worker(job)
+        job.append_log(f"> transcribe {video_path}\n")
+        transcribe_subsai.request(args.whisper_port, base_dir, [filename], video_ext,
+                                  log=lambda line: job.append_log('[转录] ' + line), progress=job.report_progress)
+        job.append_log("\n=== transcribe_subsai.py finished ===\n")
+        job.add_artifact('subtitles', os.path.join(base_dir, f'{filename}.jp.srt'))
+    return jobs.Step('transcribe', 'gpu', run, {'video_path': video_path})
+
+def translate_step(video_path, batchsize, hint, api_key=''):
+    base_dir = os.path.dirname(video_path)
+    filename = os.path.splitext(os.path.basename(video_path))[0]
+
+    def run(job):
+        # runs in the thread of the API pool, the SDK is imported once per server
+        def log(message):
+            job.append_log(f'[翻译] {message}\n')
+
+        job.append_log(f"> translate {video_path} ({args.translate_api})\n")
+        if args.translate_api == 'gemini':
+            key = api_key or args.api_key
+            translator = translate.Translator(key, 'zh-cn', hint, limiter=limiter_for(key), proxy=args.proxy,
+                                              log=log, progress=job.report_progress)
+            translate.translate_files(translator, base_dir, [filename], 'jp', 'zh-cn', batchsize=int(batchsize), jobs=1)
+        else:
+            specs = args.local_endpoints or [translate_ollama.default_endpoints[args.translate_api]]
+            pool = endpoints.EndpointPool([endpoints.Endpoint(args.translate_api, *endpoints.parse_endpoint(s)) for s in specs])
+            translator = translate_ollama.Translator(pool, args.local_model, 'jp', 'zh-cn', hint, batchsize=int(batchsize),
+                                                     log=log, progress=job.report_progress)
+            asyncio.run(translator.translate_files(base_dir, [filename], 'jp', 'zh-cn'))
+        job.append_log("\n=== translation finished ===\n")
+        job.add_artifact('translation', os.path.join(base_dir, f'{filename}.zh-cn.srt'))
+    # the key is not saved: a job restored after a restart uses --api-key
+    return jobs.Step('translate', 'api', run, {'video_path': video_path, 'batchsize': batchsize, 'hint': hint})
+
+# e.g. " 45.2% ( 12.1/ 26.7MB) ├████──────┤[1/2]    2 MB/s"
+youget_progress = re.compile(r"^\s*([\d.]+)% \(\s*([\d.]+)/\s*([\d.]+)MB\)(?:.*\[(\d+/\d+)\])?")
+# audio codecs an mp4 file takes as they are, others are encoded to aac
+mp4_audio_codecs = {'aac', 'mp3', 'alac', 'ac3', 'eac3'}
+audio_ext = {'aac': '.m4a', 'alac': '.m4a', 'mp3': '.mp3'}
+video_exts = ('.mp4', '.flv', '.mkv', '.webm', '.mov', '.ts')
+
+def probe_streams(path):
+    # {codec_type: codec_name} of the first stream of each type
+    try:
+        result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name', '-of', 'json', path],
+                                capture_output=True, text=True, env=path_env())
+    except OSError:
+        # no ffprobe: nothing is known about the file
+        return {}
+    streams = {}
+    for stream in json.loads(result.stdout or '{}').get('streams', []):
+        streams.setdefault(stream.get('codec_type'), stream.get('codec_name'))
+    return streams
+
+def downloaded_parts(dest_path):
+    # the parts you-get has finished: it writes "name[00].mp4.download" and renames it at the end
+    parts = glob.glob(glob.escape(dest_path) + '[[]*[]].*')
+    return sorted(p for p in parts if not p.endswith('.download'))
+
+def submit_pipeline(video_path):
+    return job_queue.submit(jobs.Job('pipeline', os.path.basename(video_path),
+                                     [transcribe_step(video_path), translate_step(video_path, 50, '')]))
+
+def download_step(url, dest_path, transcribe=False):
+    envr = path_env()
+
+    def start_transcription(job, path, streams):
+        # the audio alone is enough for whisper: cut it out of the part by stream copy
+        audio_path = dest_path + audio_ext.get(streams['audio'], '.mka')
+        try:
+            subprocess.run(['ffmpeg', '-y', '-v', 'error', '-i', path, '-vn', '-c:a', 'copy', audio_path], env=envr, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            # not worth failing the download: the whole video is transcribed at the end instead
+            job.append_log(f"*** 提取音频失败: {e} ***\n")
+            return
+        job.add_artifact('audio', audio_path)
+        pipeline = submit_pipeline(audio_path)
+        job.append_log(f"音频已完成，已提交转录任务 {pipeline.id}\n")
+
+    def run(job):
+        probed = {}
+        last_check = 0
+
+        def check_parts():
+            # a part is done when you-get has renamed it; an audio-only part goes to the transcription right away
+            for part in downloaded_parts(dest_path):
+                if part not in probed:
+                    probed[part] = probe_streams(part)
+                    if 'audio' in probed[part] and 'video' not in probed[part]:
+                        start_transcription(job, part, probed[part])
+                        return
+
+        def on_line(line):
+            nonlocal last_check
+            m = youget_progress.match(line)
+            if m is not None:
+                job.report_progress(f"[{m.group(4)}]" if m.group(4) else '', int(float(m.group(2)) * 1024), int(float(m.group(3)) * 1024))
+            if transcribe and 'audio' not in job.artifacts and time.time() - last_check > 1:
+                last_check = time.time()
+                check_parts()
+            # the progress, and the empty lines left between its redraws
+            return m is not None or not line.strip()
+
+        envr['PYTHONUNBUFFERED'] = '1'
+        # build you-get command using -O as requested
+        youget_cmd = ['you-get', '-O', dest_path, url]
+        jobs.run_command(job, youget_cmd, envr, '[下载] ', on_line)
+        if transcribe and 'audio' not in job.artifacts:
+            # the audio may be the last part, it is still transcribed while the parts are merged
+            check_parts()
+        parts = downloaded_parts(dest_path)
+        codecs = [probed.get(p) or probe_streams(p) for p in parts]
+        video_only = [p for p, c in zip(parts, codecs) if 'video' in c and 'audio' not in c]
+        audio_only = [p for p, c in zip(parts, codecs) if 'audio' in c and 'video' not in c]
+        if len(parts) == 2 and len(video_only) == 1 and len(audio_only) == 1:
+            # 合并音频视频为mp4, copying the audio when mp4 takes its codec
+            audio = codecs[parts.index(audio_only[0])]['audio']
+            audio_codec = 'copy' if audio in mp4_audio_codecs else 'aac'
+            job.append_log(f"> ffmpeg 合并视频和音频，音频 {audio} -> {audio_codec}\n")
+            subprocess.run(['ffmpeg', '-y', '-v', 'error', '-i', video_only[0], '-i', audio_only[0], '-map', '0:v', '-map', '1:a',
+                            '-c:v', 'copy', '-c:a', audio_codec, dest_path + ".mp4"], env=envr, check=True)
+            video_path = dest_path + ".mp4"
+        elif len(parts) >= 2 and all(c and c == codecs[0] for c in codecs):
+            # consecutive segments of one video, e.g. name[00].flv, name[01].flv: joined one after the other
+            video_path = dest_path + os.path.splitext(parts[0])[1]
+            list_path = dest_path + '.concat.txt'
+            with open(list_path, 'w', encoding='utf-8') as f:
+                for p in parts:
+                    f.write("file '" + os.path.abspath(p).replace("'", "'\\''") + "'\n")
+            job.append_log(f"> ffmpeg 拼接 {len(parts)} 个分段\n")
+            try:
+                subprocess.run(['ffmpeg', '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy', video_path],
+                               env=envr, check=True)
+            finally:
+                os.remove(list_path)
+        elif parts:
+            # nothing known to join them by: keep the parts as they are
+            if len(parts) >= 2:
+                job.append_log(f"*** 无法合并的 {len(parts)} 个文件，保持原样 ***\n")
+            video_path = parts[0]
+        else:
+            found = sorted(p for p in glob.glob(glob.escape(dest_path) + '.*') if os.path.splitext(p)[1].lower() in video_exts)
+            video_path = found[0] if found else dest_path
+        job.add_artifact('video', video_path)
+        if transcribe and 'audio' not in job.artifacts:
+            pipeline = submit_pipeline(video_path)
+            job.append_log(f"已提交转录任务 {pipeline.id}\n")
+    return jobs.Step('download', 'download', run, {'url': url, 'dest_path': dest_path, 'transcribe': transcribe})
+
+step_makers = {'transcribe': transcribe_step, 'translate': translate_step, 'download': download_step}
+
+def make_step(name, params):
+    return step_makers[name](**params)
 
 @app.route('/', methods=['GET'])
 def index():
@@ -98,73 +274,33 @@ def start():
     api_key = request.form['api_key']
     batchsize = request.form['batchsize']
     hint = request.form['hint']
-    filename = os.path.splitext(os.path.basename(video_path))[0]
-    process_info['step'] = None
-    process_info['log'] = []
-
-    thread = threading.Thread(target=run_task, args=(video_path, api_key, batchsize, hint, None))
-    thread.start()
-    return jsonify({'status': 'started'})
+    # the transcription runs in the GPU pool, then the translation in the API pool
+    job = job_queue.submit(jobs.Job('pipeline', os.path.basename(video_path),
+                                    [transcribe_step(video_path), translate_step(video_path, batchsize, hint, api_key)]))
+    return jsonify({'status': 'started', 'job_id': job.id})
 
 @app.route('/download', methods=['POST'])
 def download():
-    # prevent starting a new job while another proc is active
-    if process_info.get('proc') is not None:
-        return jsonify({'error': '已有任务在运行，请稍后再试。'}), 400
-
     url = request.form.get('download_url', '').strip()
     filename = request.form.get('download_filename', '').strip()
     if not url or not filename:
         return jsonify({'error': '请提供 URL 和 文件名'}), 400
 
     filename = sanitize_filename(filename)
-    dest_dir = r"C:\shared"
+    dest_dir = args.download_dir
     try:
         os.makedirs(dest_dir, exist_ok=True)
     except Exception as e:
         return jsonify({'error': f'无法创建目录 {dest_dir}: {e}'}), 500
 
     dest_path = os.path.join(dest_dir, filename)
-
-    # build you-get command using -O as requested
-    youget_cmd = ['you-get', '-O', dest_path, url]
-
-    # prepare env (include path env if provided)
-    envr = os.environ.copy()
-    envr["PATH"] = args.path_env + os.pathsep + envr.get("PATH", "")
-
-    # clear previous log and set step
-    process_info['log'] = []
-    process_info['step'] = 'download'
-
-    def worker():
-        try:
-            process_info['proc'] = subprocess.Popen(youget_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1, env=envr, encoding='utf-8')
-            proc = process_info['proc']
-            process_info['log'].append(f"> {' '.join(youget_cmd)}\n")
-            for line in proc.stdout:
-                process_info['log'].append('[下载] ' + line)
-            proc.wait()
-            process_info['log'].append(f"\n=== you-get exited with code {proc.returncode} ===\n")
-            # 合并音频视频为mp4
-            if os.path.exists(dest_path+"[00].mp4") and os.path.exists(dest_path+"[01].mp4"):
-                subprocess.run(["ffmpeg", "-i", dest_path+"[00].mp4", "-i", dest_path+"[01].mp4", "-c:v", "copy", "-c:a", "aac", dest_path + ".mp4"], env=envr)
-        except Exception as e:
-            process_info['log'].append(f"\n*** 下载异常: {e} ***\n")
-        finally:
-            process_info['proc'] = None
-            process_info['step'] = None
-
-    thread = threading.Thread(target=worker, daemon=True)
-    thread.start()
-    return jsonify({'status': 'download_started'})
+    # transcribe and translate the video as soon as its audio is downloaded
+    transcribe = request.form.get('auto_transcribe') == 'on'
+    job = job_queue.submit(jobs.Job('download', filename, [download_step(url, dest_path, transcribe)]))
+    return jsonify({'status': 'download_started', 'job_id': job.id})
 
 @app.route('/translate', methods=['POST'])
 def translate_only():
-    # prevent starting a new job while another proc is active
-    if process_info.get('proc') is not None:
-        return jsonify({'error': '已有任务在运行，请稍后再试。'}), 400
-
     video_path = request.form.get('video_path', '').strip()
     api_key = request.form.get('api_key', '').strip()
     batchsize = request.form.get('batchsize', '50').strip()
@@ -173,62 +309,101 @@ def translate_only():
     if not video_path:
         return jsonify({'error': '未提供视频路径'}), 400
 
-    base_dir = os.path.dirname(video_path)
-    filename = os.path.splitext(os.path.basename(video_path))[0]
+    job = job_queue.submit(jobs.Job('translate', os.path.basename(video_path), [translate_step(video_path, batchsize, hint, api_key)]))
+    return jsonify({'status': 'translate_started', 'job_id': job.id})
 
-    # prepare env for translate (reuse proxy handling)
-    envr = os.environ.copy()
-    envr["HTTP_PROXY"] = args.proxy
-    envr["HTTPS_PROXY"] = args.proxy
-    envr['http_proxy'] = args.proxy
-    envr['https_proxy'] = args.proxy
-    # make sure PATH from args.path_env is included if provided
-    envr["PATH"] = args.path_env + os.pathsep + envr.get("PATH", "")
+@app.route('/jobs')
+def list_jobs():
+    # the running jobs and the latest ?limit= ones, later changes come from /jobs/events
+    limit = request.args.get('limit', '50')
+    limit = int(limit) if limit.isdigit() else 50
+    return jsonify([job.to_dict() for job in job_queue.recent(limit)])
+
+@app.route('/jobs/events')
+def job_events():
+    """
+    Server-sent `job` events with the job whenever one is submitted or changes
+    status, so the page keeps its list without polling /jobs. Without
+    Last-Event-ID the stream starts with the next change.
+    """
+    last = request.headers.get('Last-Event-ID') or ''
+    last = int(last) if last.isdigit() else job_queue.changes.seq
+    if last > job_queue.changes.seq:
+        # seen before a restart
+        last = 0
 
-    # clear previous log and set step
-    process_info['log'] = []
-    process_info['step'] = 'translate'
+    def stream(last):
+        while True:
+            new = job_queue.changes.wait(last, timeout=15)
+            for seq, kind, data in new:
+                yield f"id: {seq}\nevent: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                last = seq
+            if not new:
+                yield ": keepalive\n\n"
 
-    def worker():
-        try:
-            key_to_use = api_key if api_key else args.api_key
-            cmd = [
-                'python', '-u', 'translate.py',
-                '--base', base_dir,
-                '--key', key_to_use,
-                '--batchsize', str(batchsize),
-                '-l', filename,
-                '--hint', hint
-            ]
-            process_info['proc'] = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1, env=envr)
-            proc = process_info['proc']
-            process_info['log'].append(f"> {' '.join(cmd)}\n")
-            for line in proc.stdout:
-                process_info['log'].append('[翻译] ' + line)
-            proc.wait()
-            process_info['log'].append(f"\n=== translate.py exited with code {proc.returncode} ===\n")
-        except Exception as e:
-            process_info['log'].append(f"\n*** 翻译异常: {e} ***\n")
-        finally:
-            process_info['proc'] = None
-            process_info['step'] = None
-
-    thread = threading.Thread(target=worker, daemon=True)
-    thread.start()
-    return jsonify({'status': 'translate_started'})
+    resp = Response(stream(last), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
 
 @app.route('/progress')
 def progress():
-    log = process_info.get('log', [])
-    content = ''.join(log)
-    running = process_info['proc'] is not None or process_info.get('step') is not None
-    step = process_info.get('step')
-    resp = make_response(jsonify({'output': content, 'running': running, 'step': step}))
+    # the job given by ?job=ID, or the latest one
+    job_id = request.args.get('job')
+    job = job_queue.get(job_id) if job_id else job_queue.latest()
+    if job_id and job is None:
+        return jsonify({'error': f'没有任务 {job_id}'}), 404
+    # only the latest lines are kept, /events/<job_id> streams the log as it grows
+    content = job.events.text() if job else ''
+    running = job.running if job else False
+    step = job.step if job else None
+    resp = make_response(jsonify({'output': content, 'running': running, 'step': step,
+                                  'job_id': job.id if job else None, 'status': job.status if job else None}))
     resp.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     resp.headers['Pragma'] = 'no-cache'
     resp.headers['Expires'] = '0'
     resp.headers['Content-Type'] = 'application/json; charset=utf-8'
     return resp
 
+@app.route('/events/<job_id>')
+def events(job_id):
+    """
+    Server-sent events of a job: `log` for every new output line, `progress`
+    for the tqdm bars and `status` when the job changes steps. A reconnecting
+    client sends Last-Event-ID and gets only the events it has not seen.
+    The stream ends with an `end` event once the job is done or failed.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': f'没有任务 {job_id}'}), 404
+    last = request.headers.get('Last-Event-ID') or request.args.get('since') or '0'
+    last = int(last) if last.isdigit() else 0
+    if last > job.events.seq:
+        # seen before a restart: progress events are not saved, so numbers can go back
+        last = 0
+
+    def stream(last):
+        while True:
+            running = job.running
+            # a finished job has no more events to wait for
+            new = job.events.wait(last, timeout=15 if running else 0)
+            for seq, kind, data in new:
+                yield f"id: {seq}\nevent: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                last = seq
+            if not running and not new:
+                yield f"event: end\ndata: {json.dumps({'status': job.status, 'error': job.error})}\n\n"
+                return
+            if not new:
+                # keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+
+    resp = Response(stream(last), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+# continue the jobs the previous server did not finish
+job_queue.restore(make_step)
+
 if __name__ == '__main__':
-    app.run(debug=False, host='0.0.0.0')
+    app.run(debug=False, host='0.0.0.0', threaded=True)
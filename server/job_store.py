@@ -0,0 +1,112 @@
+"""
+Jobs of the web server, kept in a SQLite database so a restarted server
+still lists them and continues the ones it was running.
+
+A step is stored by its name and the parameters it was created with, and is
+created again from them on restart, and an interrupted job runs again from
+the step it was in. Finished steps are not run again, and translate.py
+resumes from its partial SRT file, so only the work in flight is lost.
+"""
+
+import json
+import sqlite3
+import threading
+from typing import List
+
+
+class JobStore:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                title TEXT NOT NULL,
+                status TEXT NOT NULL,
+                next_step INTEGER NOT NULL DEFAULT 0,
+                step TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                finished REAL
+            )""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS steps (
+                job_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                PRIMARY KEY (job_id, idx)
+            )""")
+            # log lines and status changes, numbered like the events of the job
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS events (
+                job_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (job_id, seq)
+            )""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS artifacts (
+                job_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (job_id, kind)
+            )""")
+
+    def save_job(self, job):
+        with self.lock, self.conn:
+            self.conn.execute("""INSERT OR REPLACE INTO jobs (id, kind, title, status, next_step, step, error, created, finished)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (job.id, job.kind, job.title, job.status, job.next_step, job.step, job.error, job.created, job.finished))
+            self.conn.executemany("INSERT OR REPLACE INTO steps (job_id, idx, name, params) VALUES (?, ?, ?, ?)",
+                                  [(job.id, i, s.name, json.dumps(s.params, ensure_ascii=False)) for i, s in enumerate(job.steps)])
+
+    def update_job(self, job):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE jobs SET status=?, next_step=?, step=?, error=?, finished=? WHERE id=?",
+                              (job.status, job.next_step, job.step, job.error, job.finished, job.id))
+            self.conn.execute("""UPDATE steps SET status = CASE WHEN idx < ? THEN 'done' WHEN idx = ? THEN ? ELSE 'pending' END
+                WHERE job_id=?""", (job.next_step, job.next_step, job.status, job.id))
+
+    def append_event(self, job_id: str, seq: int, kind: str, data, keep: int = 0):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO events (job_id, seq, kind, data) VALUES (?, ?, ?, ?)",
+                              (job_id, seq, kind, json.dumps(data, ensure_ascii=False)))
+            # a long job keeps at most `keep` (+100) events while it runs, see trim_events
+            if keep and seq % 100 == 0:
+                self.conn.execute("DELETE FROM events WHERE job_id=? AND seq <= ?", (job_id, seq - keep))
+
+    def trim_events(self, job_id: str, keep: int):
+        # only the events a job keeps in memory are worth restoring
+        with self.lock, self.conn:
+            self.conn.execute("""DELETE FROM events WHERE job_id=? AND seq <=
+                (SELECT MAX(seq) FROM events WHERE job_id=?) - ?""", (job_id, job_id, keep))
+
+    def add_artifact(self, job_id: str, kind: str, path: str):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO artifacts (job_id, kind, path) VALUES (?, ?, ?)", (job_id, kind, path))
+
+    def load_jobs(self, keep_events: int) -> List[dict]:
+        """Every stored job as a dict, oldest first, with its steps, artifacts and latest events."""
+        with self.lock:
+            rows = self.conn.execute("""SELECT id, kind, title, status, next_step, step, error, created, finished
+                FROM jobs ORDER BY created""").fetchall()
+            result = []
+            for id, kind, title, status, next_step, step, error, created, finished in rows:
+                steps = self.conn.execute("SELECT name, params FROM steps WHERE job_id=? ORDER BY idx", (id,)).fetchall()
+                artifacts = self.conn.execute("SELECT kind, path FROM artifacts WHERE job_id=?", (id,)).fetchall()
+                events = self.conn.execute("SELECT seq, kind, data FROM events WHERE job_id=? ORDER BY seq DESC LIMIT ?",
+                                           (id, keep_events)).fetchall()
+                result.append({
+                    'id': id, 'kind': kind, 'title': title, 'status': status, 'next_step': next_step, 'step': step,
+                    'error': error, 'created': created, 'finished': finished,
+                    'steps': [(name, json.loads(params)) for name, params in steps],
+                    'artifacts': dict(artifacts),
+                    'events': [(seq, kind, json.loads(data)) for seq, kind, data in reversed(events)],
+                })
+        return result
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,274 @@
+"""
+Job queue of the web server.
+
+A job is a list of steps, and each step runs in the worker pool of the
+resource it needs: "gpu" for the local whisper transcription, "api" for the
+translation and "download" for you-get. When a step finishes, the next step of
+the job is queued to its own pool, so the transcription of one video overlaps
+with the translation of another.
+
+The output of a job is kept as a bounded list of numbered events (log lines,
+progress of the tqdm bars and status changes), so clients can follow a job by
+asking for the events after the last one they have seen.
+
+With a JobStore, jobs, their log and their artifacts are saved as they change,
+and JobQueue.restore() loads them again after a restart.
+"""
+
+import collections
+import queue
+import re
+import subprocess
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+
+from job_store import JobStore
+
+# a tqdm bar after the prefix of the step, e.g.
+# "[翻译] ep1.jp.srt:  60%|██████    | 300/500 [00:10<00:06, 29.7it/s]"
+progress_pattern = re.compile(r"^(?:\[[^\]]*\])?\s*(?:(.*?):\s*)?(\d+)%\|[^|]*\|\s*(\d+)/(\d+)")
+
+
+def parse_progress(line: str) -> Optional[dict]:
+    m = progress_pattern.match(line)
+    if m is None:
+        return None
+    return {'desc': m.group(1) or '', 'percent': int(m.group(2)), 'n': int(m.group(3)), 'total': int(m.group(4))}
+
+
+class JobFailed(Exception):
+    pass
+
+
+class Step:
+    def __init__(self, name: str, pool: str, run: Callable[["Job"], None], params: Optional[dict] = None):
+        self.name = name
+        self.pool = pool
+        self.run = run
+        # the arguments the step was made from, to make it again after a restart
+        self.params = params or {}
+
+
+class EventLog:
+    """The latest `size` events of a job, numbered from 1."""
+
+    def __init__(self, size: int = 2000, events=()):
+        self.events = collections.deque(events, maxlen=size)
+        self.seq = self.events[-1][0] if self.events else 0
+        self.changed = threading.Condition()
+
+    def append(self, kind: str, data) -> int:
+        with self.changed:
+            self.seq += 1
+            self.events.append((self.seq, kind, data))
+            self.changed.notify_all()
+            return self.seq
+
+    def since(self, seq: int) -> List[Tuple[int, str, object]]:
+        with self.changed:
+            # the wanted events are at the end (restored events may skip numbers)
+            new = []
+            for event in reversed(self.events):
+                if event[0] <= seq:
+                    break
+                new.append(event)
+        return new[::-1]
+
+    def wait(self, seq: int, timeout: float) -> List[Tuple[int, str, object]]:
+        """Waits up to `timeout` seconds for events after `seq`."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.seq > seq, timeout)
+        return self.since(seq)
+
+    def text(self) -> str:
+        with self.changed:
+            return ''.join(data for _, kind, data in self.events if kind == 'log')
+
+
+class Job:
+    def __init__(self, kind: str, title: str, steps: List[Step], id: Optional[str] = None):
+        self.id = id or uuid.uuid4().hex[:8]
+        self.kind = kind
+        self.title = title
+        self.steps = steps
+        self.next_step = 0
+        # queued -> running -> (queued -> running ...) -> done / failed
+        self.status = "queued"
+        self.step: Optional[str] = None
+        self.error: Optional[str] = None
+        self.events = EventLog()
+        # the latest progress of the running step
+        self.progress: Optional[dict] = None
+        # files made by the job, e.g. {'video': ..., 'subtitles': ...}
+        self.artifacts: Dict[str, str] = {}
+        self.proc: Optional[subprocess.Popen] = None
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self.store: Optional[JobStore] = None
+
+    @property
+    def running(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def append_log(self, line: str):
+        # progress bars redraw the same line over and over: keep only the latest state
+        progress = parse_progress(line)
+        if progress is not None:
+            self.report_progress(progress['desc'], progress['n'], progress['total'])
+        else:
+            self.save_event('log', line)
+
+    def report_progress(self, desc: str, n: int, total: int):
+        self.progress = {'desc': desc, 'percent': n * 100 // total if total else 0, 'n': n, 'total': total, 'step': self.step}
+        self.events.append('progress', self.progress)
+
+    def save_event(self, kind: str, data):
+        seq = self.events.append(kind, data)
+        if self.store is not None:
+            self.store.append_event(self.id, seq, kind, data, self.events.events.maxlen)
+
+    def add_artifact(self, kind: str, path: str):
+        self.artifacts[kind] = path
+        if self.store is not None:
+            self.store.add_artifact(self.id, kind, path)
+
+    def update(self, status: str, step: Optional[str] = None, error: Optional[str] = None):
+        self.status = status
+        self.step = step
+        self.error = error
+        self.progress = None
+        if not self.running:
+            self.finished = time.time()
+        if self.store is not None:
+            self.store.update_job(self)
+            if not self.running:
+                self.store.trim_events(self.id, self.events.events.maxlen)
+        self.save_event('status', {'status': status, 'step': step, 'error': error})
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'title': self.title,
+            'status': self.status,
+            'step': self.step,
+            'steps': [s.name for s in self.steps],
+            'error': self.error,
+            'progress': self.progress,
+            'artifacts': self.artifacts,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+
+def run_command(job: Job, cmd: List[str], env: dict, prefix: str, on_line: Optional[Callable[[str], bool]] = None):
+    """Runs one process of a job, with its output going to the job log.
+
+    `on_line` sees every output line first, and returns True for the lines it
+    took care of (e.g. progress) so they are not logged."""
+    # do not leak the API key into the log
+    shown = ['***' if i > 0 and cmd[i - 1] == '--key' else c for i, c in enumerate(cmd)]
+    job.append_log(f"> {' '.join(shown)}\n")
+    job.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, universal_newlines=True, env=env, encoding='utf-8')
+    try:
+        for line in job.proc.stdout:
+            if on_line is None or not on_line(line):
+                job.append_log(prefix + line)
+        job.proc.wait()
+    except BaseException:
+        # e.g. on_line failed: do not leave the process running without a reader
+        job.proc.kill()
+        job.proc.wait()
+        raise
+    finally:
+        returncode = job.proc.returncode
+        job.proc = None
+    job.append_log(f"\n=== {cmd[2] if cmd[0] == 'python' else cmd[0]} exited with code {returncode} ===\n")
+    if returncode != 0:
+        raise JobFailed(f"{' '.join(shown[:3])} exited with code {returncode}")
+
+
+class JobQueue:
+    def __init__(self, workers: Dict[str, int], store: Optional[JobStore] = None):
+        self.lock = threading.Lock()
+        self.store = store
+        # every job submitted to the server (or restored from the store), oldest first
+        self.jobs: Dict[str, Job] = {}
+        self.queues = {pool: queue.Queue() for pool in workers}
+        # a `job` event with the job whenever one changes status, for the job list of the page
+        self.changes = EventLog(size=200)
+        for pool, count in workers.items():
+            for _ in range(max(count, 1)):
+                threading.Thread(target=self.worker, args=(pool,), daemon=True).start()
+
+    def submit(self, job: Job) -> Job:
+        with self.lock:
+            self.jobs[job.id] = job
+        if self.store is not None:
+            job.store = self.store
+            self.store.save_job(job)
+        self.enqueue(job)
+        return job
+
+    def restore(self, make_step: Callable[[str, dict], Step]):
+        """Loads the stored jobs, and queues again the ones the last server did not finish."""
+        for record in self.store.load_jobs(EventLog().events.maxlen):
+            job = Job(record['kind'], record['title'], [make_step(name, params) for name, params in record['steps']], record['id'])
+            job.next_step = record['next_step']
+            job.status, job.step, job.error = record['status'], record['step'], record['error']
+            job.created, job.finished = record['created'], record['finished']
+            job.artifacts = record['artifacts']
+            job.events = EventLog(events=record['events'])
+            job.store = self.store
+            with self.lock:
+                self.jobs[job.id] = job
+            if job.running:
+                job.append_log(f"\n*** 服务器重启，从 {job.steps[job.next_step].name} 继续 ***\n")
+                self.enqueue(job)
+
+    def update(self, job: Job, status: str, step: Optional[str] = None, error: Optional[str] = None):
+        job.update(status, step, error)
+        self.changes.append('job', job.to_dict())
+
+    def enqueue(self, job: Job):
+        step = job.steps[job.next_step]
+        self.update(job, "queued", step.name)
+        self.queues[step.pool].put(job)
+
+    def worker(self, pool: str):
+        while True:
+            job = self.queues[pool].get()
+            step = job.steps[job.next_step]
+            self.update(job, "running", step.name)
+            try:
+                step.run(job)
+            except Exception as e:
+                job.append_log(f"\n*** {step.name} 异常: {e} ***\n")
+                self.update(job, "failed", step.name, str(e))
+                continue
+            job.next_step += 1
+            if job.next_step < len(job.steps):
+                self.enqueue(job)
+            else:
+                self.update(job, "done")
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self.lock:
+            return list(self.jobs.values())
+
+    def recent(self, limit: int) -> List[Job]:
+        # the queued and running jobs, and the latest `limit` jobs, oldest first
+        with self.lock:
+            jobs = list(self.jobs.values())
+        latest = set(job.id for job in jobs[-limit:]) if limit > 0 else set()
+        return [job for job in jobs if job.running or job.id in latest]
+
+    def latest(self) -> Optional[Job]:
+        with self.lock:
+            return next(reversed(self.jobs.values()), None)
@@ -0,0 +1,227 @@
+"""
+Streaming reader and writer of SRT subtitle files.
+
+Cues are read one at a time, so large files are never held in memory as a
+whole. Timestamps are integer milliseconds.
+
+An output file can be resumed after a crash: the writer keeps a checkpoint
+`{path}.ckpt` with the number of cues and bytes flushed and the source file
+they were made from, and resume_output() cuts the file back to its last
+complete cue. Without a checkpoint of the same source, nothing is resumed.
+TranslationOutput puts this together for the translation scripts.
+"""
+
+import itertools
+import json
+import os
+from typing import Iterator, Optional
+
+import tqdm
+
+
+class Cue:
+    __slots__ = ("index", "start", "end", "text")
+
+    def __init__(self, index: int, start: int, end: int, text: str):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.text = text
+
+    def __repr__(self):
+        return f"Cue({self.index}, {format_time(self.start)} --> {format_time(self.end)}, {self.text!r})"
+
+
+def parse_time(s: str) -> int:
+    hms, _, ms = s.strip().replace(".", ",").partition(",")
+    h, m, sec = hms.split(":")
+    return ((int(h) * 60 + int(m)) * 60 + int(sec)) * 1000 + int((ms or "0").ljust(3, "0")[:3])
+
+
+def format_time(ms: int) -> str:
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d},{ms % 1000:03d}"
+
+
+def is_timing_line(line: str) -> bool:
+    return " --> " in line
+
+
+def read_srt(path: str) -> Iterator[Cue]:
+    with open(path, encoding="utf-8-sig") as f:
+        cue: Optional[Cue] = None
+        lines = []
+        # a line of digits is the number of the next cue only if a timing line
+        # follows it, otherwise it is part of the text
+        number: Optional[str] = None
+        count = 0
+        for line in f:
+            line = line.strip()
+            if is_timing_line(line):
+                if cue is not None:
+                    cue.text = "\n".join(lines)
+                    yield cue
+                count += 1
+                st, ed = line.split(" --> ", 1)
+                cue = Cue(int(number) if number is not None else count, parse_time(st), parse_time(ed.split()[0]), "")
+                lines = []
+                number = None
+                continue
+            if number is not None:
+                lines.append(number)
+                number = None
+            if line.isdigit():
+                number = line
+            elif line and cue is not None:
+                lines.append(line)
+        if cue is not None:
+            if number is not None:
+                lines.append(number)
+            cue.text = "\n".join(lines)
+            yield cue
+
+
+def count_cues(path: str) -> int:
+    with open(path, encoding="utf-8-sig") as f:
+        return sum(1 for line in f if is_timing_line(line))
+
+
+def checkpoint_path(path: str) -> str:
+    return path + ".ckpt"
+
+
+def scan_complete(path: str):
+    # (cues, bytes) of the complete cues at the start of a file written without a
+    # checkpoint. A cue is complete once the blank line closing it is written
+    starts = 0
+    complete = (0, 0)
+    offset = 0
+    number = False
+    with open(path, "rb") as f:
+        for line in f:
+            stripped = line.strip().lstrip(b"\xef\xbb\xbf")
+            offset += len(line)
+            if number and b" --> " in stripped:
+                starts += 1
+            elif not stripped and starts and line.endswith(b"\n"):
+                complete = (starts, offset)
+            number = stripped.isdigit()
+    return complete
+
+
+def source_fingerprint(path: str) -> dict:
+    # a source file changed since the checkpoint (e.g. transcribed again) is not resumed
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+def resume_output(path: str, source: str) -> int:
+    """Cuts the output file of an unfinished run on `source` back to its last
+    complete cue, and returns the number of cues kept. Returns 0 if there is no
+    checkpoint of the same source file, e.g. the run finished or the source changed."""
+    if not os.path.exists(path):
+        return 0
+    try:
+        with open(checkpoint_path(path)) as f:
+            ckpt = json.load(f)
+        if ckpt.get("source") != source_fingerprint(source):
+            return 0
+        cues, offset = ckpt["cues"], ckpt["offset"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        return 0
+    size = os.path.getsize(path)
+    if offset > size:
+        # the checkpoint is ahead of the file
+        cues, offset = scan_complete(path)
+    if offset < size:
+        with open(path, "r+b") as f:
+            f.truncate(offset)
+    return cues
+
+
+class SrtWriter:
+    def __init__(self, path: str, mode: str = "w", checkpoint: bool = False, written: int = 0, source: Optional[str] = None):
+        self.path = path
+        self.file = open(path, mode, encoding="utf-8-sig")
+        self.checkpoint = checkpoint
+        # the file the cues are made from, recorded in the checkpoint
+        self.source = source_fingerprint(source) if checkpoint and source else None
+        if checkpoint and "w" in mode and os.path.exists(checkpoint_path(path)):
+            os.remove(checkpoint_path(path))
+        # number of cues in the file, including the ones of a resumed file
+        self.written = written
+
+    def write(self, cue: Cue):
+        self.file.write(f"{cue.index}\n{format_time(cue.start)} --> {format_time(cue.end)}\n{cue.text}\n\n")
+        self.written += 1
+
+    def flush(self):
+        self.file.flush()
+        if self.checkpoint:
+            tmp = checkpoint_path(self.path) + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"cues": self.written, "offset": os.fstat(self.file.fileno()).st_size, "source": self.source}, f)
+            os.replace(tmp, checkpoint_path(self.path))
+
+    def finish(self):
+        # the file is complete, so there is nothing to resume
+        self.close()
+        if os.path.exists(checkpoint_path(self.path)):
+            os.remove(checkpoint_path(self.path))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TranslationOutput:
+    """The output file of a translation of `src_path`, continuing an unfinished one
+    unless `resume` is given (see resume_output). The cues written are reported to
+    a tqdm bar, or to `progress(file name, cues written, total cues)` if given."""
+
+    def __init__(self, src_path: str, out_path: str, resume: int = -1, position: int = 0, log=print, progress=None):
+        if resume < 0:
+            # continue after the last complete cue of an unfinished output file
+            resume = resume_output(out_path, src_path)
+            if resume:
+                log(f"Resuming {os.path.basename(out_path)} after {resume} conversations")
+        # the cues still to translate: the first `resume` ones are already in the output file
+        self.cues = read_srt(src_path)
+        for _ in itertools.islice(self.cues, resume):
+            pass
+        self.writer = SrtWriter(out_path, "w" if resume == 0 else "a", checkpoint=True, written=resume, source=src_path)
+        self.name = os.path.basename(src_path)
+        self.total = count_cues(src_path)
+        self.progress = progress
+        self.bar = tqdm.tqdm(total=self.total, initial=resume, desc=self.name, position=position, disable=progress is not None)
+        self.reported = resume
+        if progress is not None:
+            progress(self.name, resume, self.total)
+
+    @property
+    def written(self) -> int:
+        return self.writer.written
+
+    def write(self, cue: Cue):
+        self.writer.write(cue)
+
+    def flush(self):
+        # saves the checkpoint, and reports the cues written since the last flush
+        self.writer.flush()
+        if self.written > self.reported:
+            self.bar.update(self.written - self.reported)
+            self.reported = self.written
+            if self.progress is not None:
+                self.progress(self.name, self.written, self.total)
+
+    def finish(self):
+        self.writer.finish()
+        self.bar.close()
+
+    def close(self):
+        self.writer.close()
+        self.bar.close()
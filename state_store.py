@@ -0,0 +1,77 @@
+"""
+Per-segment transcription state of one media file, kept in a SQLite database.
+
+Every finished segment is one row committed atomically, so a crash can at most
+lose the segments that were still in flight, and segments may finish in any
+order (e.g. with `transcribe.py --parallel`).
+"""
+
+import sqlite3
+import threading
+from typing import Dict, Tuple
+
+
+class SegmentStore:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS segments (
+                idx INTEGER PRIMARY KEY,
+                uri TEXT,
+                response TEXT,
+                prompt_tokens INTEGER DEFAULT 0,
+                output_tokens INTEGER DEFAULT 0,
+                started REAL DEFAULT 0,
+                elapsed REAL DEFAULT 0,
+                start REAL,
+                end REAL,
+                partial TEXT
+            )""")
+
+    def save_result(self, idx: int, uri: str, response: str, prompt_tokens: int = 0, output_tokens: int = 0,
+                    started: float = 0, elapsed: float = 0):
+        with self.lock, self.conn:
+            self.conn.execute("""INSERT INTO segments (idx, uri, response, prompt_tokens, output_tokens, started, elapsed)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(idx) DO UPDATE SET uri=excluded.uri, response=excluded.response,
+                    prompt_tokens=excluded.prompt_tokens, output_tokens=excluded.output_tokens,
+                    started=excluded.started, elapsed=excluded.elapsed, partial=NULL""",
+                (idx, uri, response, prompt_tokens, output_tokens, started, elapsed))
+
+    def save_partial(self, idx: int, uri: str, partial: str):
+        # the complete blocks of a streamed response that has not finished yet
+        with self.lock, self.conn:
+            self.conn.execute("""INSERT INTO segments (idx, uri, partial) VALUES (?, ?, ?)
+                ON CONFLICT(idx) DO UPDATE SET uri=excluded.uri, partial=excluded.partial""", (idx, uri, partial))
+
+    def set_offset(self, idx: int, start: float, end: float):
+        with self.lock, self.conn:
+            self.conn.execute("""INSERT INTO segments (idx, start, end) VALUES (?, ?, ?)
+                ON CONFLICT(idx) DO UPDATE SET start=excluded.start, end=excluded.end""", (idx, start, end))
+
+    def offsets(self) -> Dict[int, Tuple[float, float]]:
+        # real (start, end) of each segment in the media file, in seconds
+        with self.lock:
+            rows = self.conn.execute("SELECT idx, start, end FROM segments WHERE start IS NOT NULL").fetchall()
+        return {idx: (start, end) for idx, start, end in rows}
+
+    def responses(self) -> Dict[int, str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT idx, response FROM segments WHERE response IS NOT NULL").fetchall()
+        return dict(rows)
+
+    def partials(self) -> Dict[int, str]:
+        with self.lock:
+            rows = self.conn.execute("SELECT idx, partial FROM segments WHERE partial IS NOT NULL AND response IS NULL").fetchall()
+        return dict(rows)
+
+    def has_results(self) -> bool:
+        # rows with only the offsets of extracted segments do not count
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM segments WHERE response IS NOT NULL LIMIT 1").fetchone() is not None
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,53 @@
+import importlib
+import os
+import sys
+import types
+
+# the modules of Kestrel are scripts at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Fields:
+    # a type of the SDK: keeps what it is given
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class Part(Fields):
+    @staticmethod
+    def from_text(text):
+        return Part(text=text)
+
+
+def stub_module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    if "." in name:
+        parent, _, child = name.rpartition(".")
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def stub_google():
+    """Stands in for the Gemini SDKs when they are not installed.
+
+    Only the imports are stubbed: the tests replace the calls they make."""
+    for name in ("google.genai", "google.generativeai"):
+        try:
+            importlib.import_module(name)
+            continue
+        except ImportError:
+            pass
+        if "google" not in sys.modules:
+            stub_module("google").__path__ = []
+        if name == "google.genai":
+            stub_module(name, Client=None)
+            stub_module("google.genai.chats")
+            stub_module("google.genai.types", Part=Part, Content=Fields, GenerateContentConfig=Fields,
+                        SafetySetting=Fields, HttpOptions=Fields)
+        else:
+            stub_module(name, types=types.SimpleNamespace(File=Fields, GenerateContentResponse=Fields))
+
+
+stub_google()
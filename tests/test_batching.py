@@ -0,0 +1,48 @@
+from batching import BatchSizer
+from ratelimit import estimate_tokens
+
+# 11 tokens, 27.5 with the expected output
+line = "x" * 30
+
+
+def test_take_fits_the_budget():
+    assert estimate_tokens(line) == 11
+    sizer = BatchSizer(10, 100, min_tokens=10)
+    assert sizer.take([line] * 5) == 3
+    # the reserved tokens (e.g. the history) leave less room
+    assert sizer.take([line] * 5, reserved=50) == 1
+
+
+def test_take_limits():
+    assert BatchSizer(2, 10000).take([line] * 5) == 2
+    # a line larger than the budget still makes a batch of its own
+    assert BatchSizer(10, 100, min_tokens=10).take(["x" * 3000, line]) == 1
+
+
+def test_shrink_and_grow():
+    sizer = BatchSizer(10, 1000, min_tokens=10)
+    assert sizer.take([line] * 5) == 5
+    sizer.shrink()
+    assert sizer.budget == 5 * 27.5 / 2
+    assert sizer.take([line] * 5) == 2
+    for _ in range(50):
+        sizer.grow()
+    assert sizer.budget == 1000
+    for _ in range(50):
+        sizer.take([line])
+        sizer.shrink()
+    assert sizer.budget == 10
+
+
+def test_observe():
+    sizer = BatchSizer(10, 1000, target_latency=5, min_tokens=10)
+    sizer.take([line] * 5)
+    sizer.observe(1, False, line, line)
+    # the output ratio moves towards the one of the reply
+    assert sizer.output_ratio == 0.8 * 1.5 + 0.2 * 1
+    assert sizer.budget == 1000
+    sizer.observe(10, False)
+    assert sizer.budget < 1000
+    budget = sizer.budget
+    sizer.observe(1, True)
+    assert sizer.budget < budget
@@ -0,0 +1,57 @@
+import sqlite3
+import time
+
+import cache
+
+
+def test_upload_cache_expiry(tmp_path):
+    path = str(tmp_path / "uploads.db")
+    uploads = cache.UploadCache(path)
+    now = time.time()
+    uploads.store("a", "files/a", now + 47 * 3600)
+    # expires before a transcription could be done with it
+    uploads.store("b", "files/b", now + 60)
+    uploads.store("c", "files/c", now + 47 * 3600)
+    assert uploads.lookup("a") == "files/a"
+    assert uploads.lookup("b") is None
+    uploads.forget("c")
+    assert uploads.lookup("c") is None
+    uploads.close()
+    # the expired entries are dropped when the cache is opened again
+    uploads = cache.UploadCache(path)
+    assert uploads.conn.execute("SELECT digest FROM uploads").fetchall() == [("a",)]
+    uploads.close()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+
+def test_response_cache_lru_bound(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "time", Clock())
+    path = str(tmp_path / "responses.db")
+    responses = cache.ResponseCache(path, max_bytes=30)
+    key = responses.make_key("model", "system", [("user", ["a"])])
+    assert key == cache.ResponseCache.make_key("model", "system", [("user", ["a"])])
+    assert key != cache.ResponseCache.make_key("model", "system", [("user", ["b"])])
+    for k in "abc":
+        responses.put(k, k * 10)
+    assert responses.get("a") == "a" * 10
+    # the least recently used response goes first
+    responses.put("d", "d" * 10)
+    assert responses.get("b") is None
+    assert [responses.get(k) for k in "acd"] == ["a" * 10, "c" * 10, "d" * 10]
+    responses.put("e", "e" * 25)
+    assert [responses.get(k) for k in "acde"] == [None, None, None, "e" * 25]
+    assert (responses.hits, responses.misses) == (5, 4)
+    responses.close()
+    # the size is counted again on the next run
+    responses = cache.ResponseCache(path, max_bytes=30)
+    assert responses.total == 25
+    responses.close()
+    assert sqlite3.connect(path).execute("SELECT COUNT(*) FROM responses").fetchone() == (1,)
@@ -0,0 +1,89 @@
+import pytest
+
+import ratelimit
+
+
+class Clock:
+    # time.monotonic and time.sleep of the limiter, without waiting
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    # the longest delay of the backoff
+    monkeypatch.setattr(ratelimit.random, "uniform", lambda low, high: high)
+    return clock
+
+
+class ApiError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+def test_error_status():
+    assert ratelimit.error_status(ApiError("quota", 429)) == 429
+    assert ratelimit.error_status(ApiError("429 Resource has been exhausted (e.g. check quota).")) == 429
+    assert ratelimit.error_status(ApiError("RESOURCE_EXHAUSTED")) == 429
+    # digits in the message are not a status
+    assert ratelimit.error_status(ApiError("output_429.mp3: 5030 tokens")) == 0
+
+
+def test_requests_per_minute(clock):
+    limiter = ratelimit.RateLimiter(rpm=2)
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeps == []
+    # one request every 30 seconds once the bucket is empty
+    limiter.acquire()
+    assert clock.sleeps == [30]
+
+
+def test_tokens_per_minute(clock):
+    limiter = ratelimit.RateLimiter(tpm=600)
+    limiter.acquire(500)
+    limiter.acquire(200)
+    assert clock.sleeps == [pytest.approx(10)]
+    # a request larger than the bucket waits for a full bucket
+    limiter.acquire(6000)
+    assert clock.sleeps[1] == pytest.approx(60)
+
+
+def test_record_usage(clock):
+    limiter = ratelimit.RateLimiter(tpm=600)
+    limiter.acquire(100)
+    # the request used 300 tokens more than estimated
+    limiter.record_usage(100, 400)
+    limiter.acquire(300)
+    assert clock.sleeps == [pytest.approx(10)]
+
+
+def test_backoff(clock):
+    limiter = ratelimit.RateLimiter(base_delay=5, max_delay=60)
+    limiter.backoff(0, ApiError("internal", 500))
+    limiter.backoff(2, ApiError("internal", 500))
+    limiter.backoff(9, ApiError("internal", 500))
+    assert clock.sleeps == [5, 20, 60]
+    assert limiter.paused_until == 0
+
+
+def test_backoff_on_quota_pauses_every_caller(clock):
+    limiter = ratelimit.RateLimiter(rpm=60, base_delay=5)
+    start = clock.now
+    limiter.backoff(1, ApiError("quota", 429))
+    # the other callers wait as long as this one sleeps
+    assert limiter.paused_until == start + 10
+    clock.now = start + 1
+    limiter.acquire()
+    assert clock.sleeps == [10, 9]
@@ -0,0 +1,319 @@
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+# the modules of the server import each other from server/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+
+import jobs
+from job_store import JobStore
+
+
+def wait_done(job, timeout=10):
+    deadline = time.time() + timeout
+    while job.running:
+        assert time.time() < deadline, job.to_dict()
+        time.sleep(0.01)
+
+
+def step(name, pool, run=lambda job: None, params=None):
+    return jobs.Step(name, pool, run, params)
+
+
+def test_steps_hand_off_between_pools():
+    queue = jobs.JobQueue({'gpu': 1, 'api': 1})
+    b_transcribing = threading.Event()
+
+    def translate_a(job):
+        # the GPU pool takes the next job while this one translates
+        assert b_transcribing.wait(5)
+
+    a = queue.submit(jobs.Job('pipeline', 'a', [step('transcribe', 'gpu'), step('translate', 'api', translate_a)]))
+    b = queue.submit(jobs.Job('pipeline', 'b', [step('transcribe', 'gpu', lambda job: b_transcribing.set()),
+                                                step('translate', 'api')]))
+    wait_done(a)
+    wait_done(b)
+    assert (a.status, b.status) == ('done', 'done')
+    assert [data['step'] for _, kind, data in a.events.since(0) if kind == 'status'] == \
+        ['transcribe', 'transcribe', 'translate', 'translate', None]
+
+
+def test_failed_step_stops_the_job(tmp_path):
+    queue = jobs.JobQueue({'gpu': 1, 'api': 1})
+    ran = []
+
+    def fail(job):
+        jobs.run_command(job, [sys.executable, '-c', 'print("working"); raise SystemExit(3)'], dict(os.environ), '[转录] ')
+
+    job = queue.submit(jobs.Job('pipeline', 'a', [step('transcribe', 'gpu', fail), step('translate', 'api', ran.append)]))
+    wait_done(job)
+    assert (job.status, job.step) == ('failed', 'transcribe')
+    assert 'exited with code 3' in job.error
+    assert ran == []
+    assert '[转录] working\n' in job.events.text()
+
+
+def test_event_log_keeps_the_latest_events():
+    log = jobs.EventLog(size=3)
+    for i in range(5):
+        log.append('log', f"{i}\n")
+    assert log.since(0) == [(3, 'log', "2\n"), (4, 'log', "3\n"), (5, 'log', "4\n")]
+    assert log.since(4) == [(5, 'log', "4\n")]
+    assert log.wait(5, timeout=0.01) == []
+    threading.Timer(0.05, log.append, ('log', "5\n")).start()
+    assert log.wait(5, timeout=5) == [(6, 'log', "5\n")]
+    assert log.text() == "3\n4\n5\n"
+
+
+def test_progress_lines_are_not_logged():
+    job = jobs.Job('translate', 'ep', [])
+    job.append_log("[翻译] ep.jp.srt:  60%|██████    | 300/500 [00:10<00:06, 29.7it/s]")
+    assert job.progress == {'desc': 'ep.jp.srt', 'percent': 60, 'n': 300, 'total': 500, 'step': None}
+    assert job.events.text() == ''
+
+
+def test_restore_resumes_the_interrupted_step(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    ran = []
+
+    def make_step(name, params):
+        def run(job):
+            ran.append(name)
+            job.add_artifact(name, params['video_path'])
+        return step(name, 'gpu' if name == 'transcribe' else 'api', run, params)
+
+    store = JobStore(path)
+    job = jobs.Job('pipeline', 'ep', [make_step(name, {'video_path': 'ep.mp4'}) for name in ('transcribe', 'translate')])
+    job.store = store
+    store.save_job(job)
+    # a server stopped during the translation
+    job.append_log("transcribed\n")
+    job.add_artifact('transcribe', 'ep.mp4')
+    job.next_step = 1
+    job.update('running', 'translate')
+    store.close()
+
+    queue = jobs.JobQueue({'gpu': 1, 'api': 1}, JobStore(path))
+    queue.restore(make_step)
+    restored = queue.get(job.id)
+    wait_done(restored)
+    assert restored.status == 'done'
+    assert ran == ['translate']
+    assert restored.artifacts == {'transcribe': 'ep.mp4', 'translate': 'ep.mp4'}
+    assert restored.events.text().startswith("transcribed\n")
+    assert "从 translate 继续" in restored.events.text()
+    # the events go on from the stored ones
+    seqs = [seq for seq, _, _ in restored.events.since(0)]
+    assert seqs == list(range(1, len(seqs) + 1))
+    # and a finished job is only listed
+    queue = jobs.JobQueue({'gpu': 1, 'api': 1}, JobStore(path))
+    queue.restore(make_step)
+    assert queue.get(job.id).status == 'done'
+    assert ran == ['translate']
+
+
+def test_stored_events_are_trimmed_while_running(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.db"))
+    job = jobs.Job('translate', 'ep', [])
+    job.events = jobs.EventLog(size=50)
+    job.store = store
+    store.save_job(job)
+    for i in range(500):
+        job.append_log(f"{i}\n")
+    count = store.conn.execute("SELECT COUNT(*) FROM events WHERE job_id=?", (job.id,)).fetchone()[0]
+    assert count <= 150
+    assert [data for _, _, data in store.load_jobs(50)[0]['events']] == [f"{i}\n" for i in range(450, 500)]
+
+
+fake_you_get = """
+import json, sys
+# the URL is the list of parts to make, as [extension, {codec_type: codec_name}]
+dest, parts = sys.argv[2], json.loads(sys.argv[3])
+for i, (ext, streams) in enumerate(parts):
+    print(f" 50.0% (  1.0/  2.0MB) ├████──────┤[{i + 1}/{len(parts)}]    2 MB/s", flush=True)
+    name = f"{dest}[{i:02d}]{ext}" if len(parts) > 1 else dest + ext
+    with open(name, "w") as f:
+        json.dump(streams, f)
+print("Merging video parts... not done", flush=True)
+"""
+
+fake_ffprobe = """
+import json, sys
+with open(sys.argv[-1]) as f:
+    streams = json.load(f)
+print(json.dumps({"streams": [{"codec_type": t, "codec_name": c} for t, c in streams.items()]}))
+"""
+
+fake_ffmpeg = """
+import json, os, sys
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ffmpeg.log"), "a") as f:
+    f.write(json.dumps(sys.argv[1:]) + "\\n")
+open(sys.argv[-1], "w").close()
+"""
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    base = tmp_path_factory.mktemp("server")
+    bin_dir = base / "bin"
+    bin_dir.mkdir()
+    for name, source in (("you-get", fake_you_get), ("ffprobe", fake_ffprobe), ("ffmpeg", fake_ffmpeg)):
+        (bin_dir / name).write_text(f"#!{sys.executable}\n{source}")
+        (bin_dir / name).chmod(0o755)
+    argv = sys.argv
+    sys.argv = ["app.py", "--api-key", "key", "--path-env", str(bin_dir), "--jobs-db", str(base / "jobs.db"),
+                "--download-dir", str(base / "downloads")]
+    try:
+        app = importlib.import_module("app")
+    finally:
+        sys.argv = argv
+    app.bin_dir = bin_dir
+    return app
+
+
+def test_progress_of_a_job(server):
+    def run(job):
+        jobs.run_command(job, [sys.executable, '-c', 'print("hi")', '--key', 'secret'], dict(os.environ), '[翻译] ')
+
+    job = server.job_queue.submit(jobs.Job('translate', 'ep', [step('translate', 'api', run)]))
+    wait_done(job)
+    client = server.app.test_client()
+    progress = client.get(f'/progress?job={job.id}').get_json()
+    assert (progress['status'], progress['running'], progress['job_id']) == ('done', False, job.id)
+    assert '[翻译] hi\n' in progress['output']
+    # the API key is masked in the logged command
+    assert 'secret' not in progress['output'] and '--key ***' in progress['output']
+    assert client.get('/progress?job=missing').status_code == 404
+    assert job.id in [j['id'] for j in client.get('/jobs').get_json()]
+
+
+def events(response):
+    # the (id, event, data) of a server-sent event stream
+    result = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if fields:
+            result.append((fields.get("id"), fields["event"], json.loads(fields["data"])))
+    return result
+
+
+def test_events_resume_from_last_event_id(server):
+    job = server.job_queue.submit(jobs.Job('translate', 'ep', [step('translate', 'api', lambda job: job.append_log("a\n"))]))
+    wait_done(job)
+    client = server.app.test_client()
+    all_events = events(client.get(f'/events/{job.id}'))
+    assert [kind for _, kind, _ in all_events] == ['status', 'status', 'log', 'status', 'end']
+    assert all_events[-1][2] == {'status': 'done', 'error': None}
+    last = all_events[1][0]
+    assert events(client.get(f'/events/{job.id}', headers={'Last-Event-ID': last})) == all_events[2:]
+    assert client.get('/events/missing').status_code == 404
+
+
+def test_job_list(server):
+    client = server.app.test_client()
+    submitted = []
+    # the test client waits for the first event
+    threading.Timer(0.1, lambda: submitted.append(server.job_queue.submit(jobs.Job('translate', 'listed', [step('translate', 'api')])))).start()
+    stream = client.get('/jobs/events', buffered=False)
+    job = submitted[0]
+    wait_done(job)
+    # every change of the job is pushed
+    chunk = next(iter(stream.response))
+    chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+    assert chunk.startswith("id: ") and "event: job" in chunk
+    assert json.loads(chunk.split("data: ", 1)[1])['id'] == job.id
+    stream.close()
+    for i in range(3):
+        wait_done(server.job_queue.submit(jobs.Job('translate', f'old {i}', [step('translate', 'api')])))
+    listed = client.get('/jobs?limit=2').get_json()
+    assert [j['title'] for j in listed] == ['old 1', 'old 2']
+
+
+class Models:
+    # answers every line of a prompt as "TR(line)"
+    def generate_content(self, model, contents, config=None):
+        prompt = contents[-1].parts[0].text
+        text = "".join(f"{line.split('::', 1)[0]}::TR({line.split('::', 1)[1]})\n" for line in prompt.split("\n"))
+        return types.SimpleNamespace(text=text + "ENDENDEND", usage_metadata=None)
+
+
+def test_translate_in_process(server, tmp_path, monkeypatch):
+    import srtfile
+    monkeypatch.setenv("KESTREL_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(server.translate.genai, "Client", lambda api_key=None, **kwargs: types.SimpleNamespace(models=Models()), raising=False)
+    with srtfile.SrtWriter(str(tmp_path / "ep.jp.srt")) as out:
+        for i in range(30):
+            out.write(srtfile.Cue(i + 1, i * 1000, i * 1000 + 500, f"line {i}"))
+    client = server.app.test_client()
+    job_id = client.post('/translate', data={'video_path': str(tmp_path / "ep.mp4"), 'batchsize': '10'}).get_json()['job_id']
+    job = server.job_queue.get(job_id)
+    wait_done(job)
+    assert job.status == 'done', job.error
+    assert [c.text for c in srtfile.read_srt(str(tmp_path / "ep.zh-cn.srt"))] == [f"TR(line {i})" for i in range(30)]
+    assert job.artifacts == {'translation': str(tmp_path / "ep.zh-cn.srt")}
+    # the progress comes from the callback of the translator, one event per batch
+    progress = [(data['n'], data['total']) for _, kind, data in job.events.since(0) if kind == 'progress']
+    assert progress == [(0, 30), (10, 30), (20, 30), (30, 30)]
+    assert job.events.since(0)[-1][2] == {'status': 'done', 'step': None, 'error': None}
+
+
+def download(server, parts, transcribe=False):
+    log = server.bin_dir / "ffmpeg.log"
+    if log.exists():
+        log.unlink()
+    client = server.app.test_client()
+    name = f"video{len(os.listdir(server.args.download_dir)) if os.path.isdir(server.args.download_dir) else 0}"
+    data = {'download_url': json.dumps(parts), 'download_filename': name}
+    if transcribe:
+        data['auto_transcribe'] = 'on'
+    job = server.job_queue.get(client.post('/download', data=data).get_json()['job_id'])
+    wait_done(job)
+    assert job.status == 'done', job.error
+    commands = [json.loads(line) for line in log.read_text().splitlines()] if log.exists() else []
+    return job, os.path.join(server.args.download_dir, name), commands
+
+
+def test_download_merges_video_and_audio(server):
+    job, dest, commands = download(server, [[".mp4", {"video": "h264"}], [".m4a", {"audio": "aac"}]])
+    assert job.artifacts == {'video': dest + ".mp4"}
+    assert len(commands) == 1 and commands[0][commands[0].index('-c:a') + 1] == 'copy'
+    # the progress lines of you-get are not logged
+    assert [(data['desc'], data['n']) for _, kind, data in job.events.since(0) if kind == 'progress'] == [('[1/2]', 1024), ('[2/2]', 1024)]
+    assert '[下载] Merging video parts... not done\n' in job.events.text()
+    # mp4 does not take opus: it is encoded to aac
+    job, dest, commands = download(server, [[".mp4", {"video": "h264"}], [".webm", {"audio": "opus"}]])
+    assert commands[0][commands[0].index('-c:a') + 1] == 'aac'
+
+
+def test_download_joins_segments(server):
+    job, dest, commands = download(server, [[".flv", {"video": "h264", "audio": "aac"}]] * 3)
+    assert job.artifacts == {'video': dest + ".flv"}
+    assert commands[0][commands[0].index('-f') + 1] == 'concat'
+    assert not os.path.exists(dest + '.concat.txt')
+
+
+def test_download_keeps_unrelated_parts(server):
+    job, dest, commands = download(server, [[".mp4", {"video": "h264", "audio": "aac"}], [".mp4", {"video": "hevc"}]])
+    assert job.artifacts == {'video': dest + "[00].mp4"}
+    assert commands == []
+    assert "无法合并的 2 个文件" in job.events.text()
+
+
+def test_download_transcribes_the_audio_part(server, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(server, 'submit_pipeline', lambda path: submitted.append(path) or types.SimpleNamespace(id='next'))
+    job, dest, commands = download(server, [[".mp4", {"video": "h264"}], [".m4a", {"audio": "aac"}]], transcribe=True)
+    # the audio is cut out of its part as soon as it is there, the whole video is not transcribed again
+    assert submitted == [dest + ".m4a"]
+    assert job.artifacts == {'audio': dest + ".m4a", 'video': dest + ".mp4"}
+    assert commands[0][commands[0].index('-i') + 1] == dest + "[01].m4a"
+    # a single file is transcribed when it is done
+    submitted.clear()
+    job, dest, commands = download(server, [[".mp4", {"video": "h264", "audio": "aac"}]], transcribe=True)
+    assert submitted == [dest + ".mp4"]
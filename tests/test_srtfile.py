@@ -0,0 +1,112 @@
+import json
+import os
+
+import srtfile
+
+
+def write_file(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def write_cues(path, n):
+    with srtfile.SrtWriter(str(path)) as out:
+        for i in range(n):
+            out.write(srtfile.Cue(i + 1, i * 1000, i * 1000 + 500, f"line {i}"))
+
+
+def test_time_round_trip():
+    assert srtfile.parse_time("01:02:03,456") == 3723456
+    assert srtfile.parse_time("00:00:01.5") == 1500
+    assert srtfile.format_time(3723456) == "01:02:03,456"
+
+
+def test_read_srt(tmp_path):
+    path = tmp_path / "a.srt"
+    write_file(path, "﻿1\n00:00:01,000 --> 00:00:02,500\nこんにちは\n2024\n\n"
+                     "2\n00:00:03,000 --> 00:00:04,000 X1:0\nfirst\nsecond\n\n"
+                     "00:00:05,000 --> 00:00:06,000\n3\n")
+    cues = list(srtfile.read_srt(str(path)))
+    assert [(c.index, c.start, c.end) for c in cues] == [(1, 1000, 2500), (2, 3000, 4000), (3, 5000, 6000)]
+    # a line of digits is text unless a timing line follows it
+    assert cues[0].text == "こんにちは\n2024"
+    assert cues[1].text == "first\nsecond"
+    assert cues[2].text == "3"
+    assert srtfile.count_cues(str(path)) == 3
+
+
+def test_writer_round_trip(tmp_path):
+    path = tmp_path / "a.srt"
+    write_cues(path, 3)
+    assert [(c.index, c.start, c.end, c.text) for c in srtfile.read_srt(str(path))] == \
+        [(1, 0, 500, "line 0"), (2, 1000, 1500, "line 1"), (3, 2000, 2500, "line 2")]
+
+
+def test_scan_complete(tmp_path):
+    path = tmp_path / "a.srt"
+    write_cues(path, 2)
+    size = os.path.getsize(path)
+    assert srtfile.scan_complete(str(path)) == (2, size)
+    # a cue without its closing blank line is not complete
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("3\n00:00:02,000 --> 00:00:03,000\nhalf")
+    assert srtfile.scan_complete(str(path)) == (2, size)
+
+
+def start_output(tmp_path, n):
+    # an interrupted run: n cues flushed, then half of the next one
+    src, out = tmp_path / "a.jp.srt", tmp_path / "a.zh-cn.srt"
+    write_cues(src, 5)
+    writer = srtfile.SrtWriter(str(out), checkpoint=True, source=str(src))
+    for i in range(n):
+        writer.write(srtfile.Cue(i + 1, 0, 1, f"done {i}"))
+    writer.flush()
+    size = os.path.getsize(out)
+    writer.file.write("9\n00:00:09,000 --> 00:00:10,000\nhal")
+    writer.close()
+    return src, out, size
+
+
+def test_resume_output(tmp_path):
+    src, out, size = start_output(tmp_path, 3)
+    assert srtfile.resume_output(str(out), str(src)) == 3
+    assert os.path.getsize(out) == size
+
+
+def test_resume_output_changed_source(tmp_path):
+    src, out, _ = start_output(tmp_path, 3)
+    stat = os.stat(src)
+    os.utime(src, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert srtfile.resume_output(str(out), str(src)) == 0
+
+
+def test_resume_output_without_checkpoint(tmp_path):
+    src, out, _ = start_output(tmp_path, 3)
+    os.remove(srtfile.checkpoint_path(str(out)))
+    assert srtfile.resume_output(str(out), str(src)) == 0
+    assert srtfile.resume_output(str(tmp_path / "missing.srt"), str(src)) == 0
+
+
+def test_resume_output_checkpoint_ahead(tmp_path):
+    src, out, size = start_output(tmp_path, 3)
+    ckpt = srtfile.checkpoint_path(str(out))
+    with open(ckpt) as f:
+        data = json.load(f)
+    data["cues"], data["offset"] = 10, size * 10
+    with open(ckpt, "w") as f:
+        json.dump(data, f)
+    # falls back to the complete cues found in the file
+    assert srtfile.resume_output(str(out), str(src)) == 3
+    assert os.path.getsize(out) == size
+
+
+def test_finish_removes_checkpoint(tmp_path):
+    src = tmp_path / "a.jp.srt"
+    write_cues(src, 1)
+    writer = srtfile.SrtWriter(str(tmp_path / "out.srt"), checkpoint=True, source=str(src))
+    writer.write(srtfile.Cue(1, 0, 1, "x"))
+    writer.flush()
+    assert os.path.exists(srtfile.checkpoint_path(writer.path))
+    writer.finish()
+    assert not os.path.exists(srtfile.checkpoint_path(writer.path))
+    assert srtfile.resume_output(writer.path, str(src)) == 0
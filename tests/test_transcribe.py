@@ -0,0 +1,145 @@
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+import cache
+import srtfile
+import state_store
+import transcribe
+
+
+class Uploads:
+    """Stands in for genai.upload_file: the first segments take the longest."""
+
+    def __init__(self, monkeypatch, count=8):
+        self.count = count
+        self.paths = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        monkeypatch.setattr(transcribe.genai, "upload_file", self.upload_file, raising=False)
+
+    def upload_file(self, path, mime_type):
+        name = path.rsplit("/", 1)[-1]
+        with self.lock:
+            self.paths.append(name)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.01 * (self.count - int(name[7:10])))
+        with self.lock:
+            self.active -= 1
+        return types.SimpleNamespace(name="files/" + name, state=types.SimpleNamespace(name="ACTIVE"))
+
+
+def segments(count):
+    return [f"files/output_{i:03d}.mp3" for i in range(count)]
+
+
+def test_upload_keeps_segment_order(tmp_path, monkeypatch):
+    uploads = Uploads(monkeypatch)
+    for i in range(8):
+        (tmp_path / f"output_{i:03d}.mp3").write_bytes(b"")
+    # the first 2 segments were uploaded by a previous run
+    (tmp_path / "uri.txt").write_text("files/output_000.mp3\nfiles/output_001.mp3\n")
+    assert transcribe.upload(str(tmp_path), 60, [], workers=4) == segments(8)
+    assert transcribe.read_uri_file(str(tmp_path / "uri.txt")) == segments(8)
+    assert sorted(uploads.paths) == [f"output_{i:03d}.mp3" for i in range(2, 8)]
+    assert uploads.max_active == 4
+
+
+def fake_ffmpeg(tmp_path):
+    # makes the segments of an "input" naming how many there are and after how many ffmpeg fails
+    script = tmp_path / "ffmpeg"
+    script.write_text(f"""#!{sys.executable}
+import os, sys
+args = sys.argv
+count, fail = map(int, open(args[args.index("-i") + 1]).read().split())
+pattern = args[-1]
+for i in range(min(count, fail)):
+    open(pattern % i, "w").close()
+    print(f"{{os.path.basename(pattern % i)}},{{i * 60}}.000000,{{(i + 1) * 60}}.000000", flush=True)
+sys.exit(1 if fail < count else 0)
+""")
+    script.chmod(0o755)
+    return str(script)
+
+
+def test_stream_extract_failure_and_resume(tmp_path, monkeypatch):
+    uploads = Uploads(monkeypatch, 4)
+    ffmpeg = fake_ffmpeg(tmp_path)
+    video, tempdir = tmp_path / "video.mp4", str(tmp_path / "temp")
+    video.write_text("4 2")
+    names = []
+    with pytest.raises(RuntimeError, match="ffmpeg returns 1"):
+        for name in transcribe.stream_extract_and_upload(str(video), tempdir, ffmpeg, 60, [], 2):
+            names.append(name)
+    # the segments made before the failure are uploaded and kept
+    assert names == segments(2)
+    assert transcribe.read_uri_file(tempdir + "/uri.txt") == segments(2)
+    video.write_text("4 4")
+    assert list(transcribe.stream_extract_and_upload(str(video), tempdir, ffmpeg, 60, [], 2)) == segments(4)
+    assert transcribe.read_uri_file(tempdir + "/uri.txt") == segments(4)
+    # the second run only uploads the new segments
+    assert sorted(uploads.paths) == [f"output_{i:03d}.mp3" for i in range(4)]
+
+
+def test_choose_cut_points_in_silences():
+    silences = [(50, 52), (90, 92), (170, 172), (250, 260)]
+    # the latest silence within the last quarter of each 100 s segment
+    assert transcribe.choose_cut_points(silences, 300, 100) == [91, 171, 255]
+
+
+def test_choose_cut_points_without_silence():
+    assert transcribe.choose_cut_points([], 250, 100) == [100, 200]
+    # a silence too early in the segment is not used
+    assert transcribe.choose_cut_points([(10, 12)], 150, 100) == [100]
+    assert transcribe.choose_cut_points([(10, 12)], 100, 100) == []
+
+
+def test_upload_segment_reuses_cached_files(tmp_path, monkeypatch):
+    uploads = Uploads(monkeypatch, 2)
+    deleted = set()
+
+    def get_file(name):
+        if name in deleted:
+            raise KeyError(name)
+        return types.SimpleNamespace(name=name, state=types.SimpleNamespace(name="ACTIVE"))
+    monkeypatch.setattr(transcribe.genai, "get_file", get_file, raising=False)
+    upload_cache = cache.UploadCache(str(tmp_path / "uploads.db"))
+    for i in range(2):
+        (tmp_path / f"output_{i:03d}.mp3").write_bytes(b"same audio")
+    assert transcribe.upload_segment(str(tmp_path / "output_000.mp3"), upload_cache) == "files/output_000.mp3"
+    # the same content is not uploaded again
+    assert transcribe.upload_segment(str(tmp_path / "output_001.mp3"), upload_cache) == "files/output_000.mp3"
+    assert uploads.paths == ["output_000.mp3"]
+    # unless the remote file is gone
+    deleted.add("files/output_000.mp3")
+    assert transcribe.upload_segment(str(tmp_path / "output_001.mp3"), upload_cache) == "files/output_001.mp3"
+    assert uploads.paths == ["output_000.mp3", "output_001.mp3"]
+    upload_cache.close()
+
+
+def test_convert(tmp_path):
+    store = state_store.SegmentStore(str(tmp_path / "state.db"))
+    store.set_offset(0, 12.3456, 72.3456)
+    store.set_offset(1, 70.0, 75.0)
+    store.close()
+    with open(tmp_path / "raw.txt", "w", encoding="utf-8") as f:
+        f.write("[[00:10~00:12\na\n[[00:10~00:12\nb\n[[00:10~00:12\nc\n[[00:20~00:20\nd\nENDENDEND\n"
+                "==========\n[[00:00~00:05\ne\n[[00:05~00:10\nf\n")
+    transcribe.convert(str(tmp_path / "video.mp4"), str(tmp_path), 60, "jp")
+    cues = [(srtfile.format_time(c.start), srtfile.format_time(c.end), c.text) for c in srtfile.read_srt(str(tmp_path / "video.jp.srt"))]
+    assert cues == [
+        # equal starts are spread over one second, in microseconds like timedelta
+        ("00:00:22,345", "00:00:22,678", "a"),
+        ("00:00:22,678", "00:00:23,012", "b"),
+        ("00:00:23,012", "00:00:24,345", "c"),
+        # an empty cue lasts half a second
+        ("00:00:32,345", "00:00:32,845", "d"),
+        # the second segment is 5 s long: its cues are shrunk to fit it
+        ("00:01:10,000", "00:01:12,500", "e"),
+        ("00:01:12,500", "00:01:15,000", "f"),
+    ]
@@ -0,0 +1,90 @@
+import re
+import threading
+import time
+import types
+
+import srtfile
+import translate
+
+
+class Models:
+    """Stands in for client.models: translates every "[[id::text" line of the
+    last prompt as "[[id::TR(text)", after `delay` seconds.
+
+    `order` reorders the lines of a reply, and the ids in `drop` are left out."""
+
+    def __init__(self, delay=0.02, order=None, drop=()):
+        self.delay = delay
+        self.order = order
+        self.drop = set(drop)
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        # called between the chunks of a streamed reply
+        self.on_chunk = lambda: None
+
+    def answer(self, contents):
+        prompt = [c for c in contents if c.role == "user" and c.parts[0].text != "continue"][-1].parts[0].text
+        lines = [(int(idx), text) for idx, text in re.findall(r"\[\[(\d+)::(.*)", prompt)]
+        if self.order:
+            lines = [lines[i] for i in self.order(len(lines))]
+        return "".join(f"[[{idx}::TR({text})\n" for idx, text in lines if idx not in self.drop) + "ENDENDEND"
+
+    def generate_content(self, model, contents, config=None):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        return types.SimpleNamespace(text=self.answer(contents), usage_metadata=None)
+
+    def generate_content_stream(self, model, contents, config=None):
+        text = self.answer(contents)
+        for i in range(0, len(text), 7):
+            self.on_chunk()
+            yield types.SimpleNamespace(text=text[i:i + 7], usage_metadata=None)
+
+
+def translator(monkeypatch, models, **options):
+    monkeypatch.setattr(translate.genai, "Client", lambda api_key=None, **kwargs: types.SimpleNamespace(models=models), raising=False)
+    return translate.Translator("key", "zh-cn", "", rpm=0, use_cache=False, **options)
+
+
+def write_source(path, n):
+    with srtfile.SrtWriter(str(path)) as out:
+        for i in range(n):
+            out.write(srtfile.Cue(i + 1, i * 1000, i * 1000 + 500, f"line {i}"))
+
+
+def texts(path):
+    return [c.text for c in srtfile.read_srt(str(path))]
+
+
+def test_translate_files_concurrently(tmp_path, monkeypatch):
+    models = Models(delay=0.05)
+    names = ["a", "b", "c"]
+    for name in names:
+        write_source(tmp_path / f"{name}.jp.srt", 30)
+    translate.translate_files(translator(monkeypatch, models), str(tmp_path), names, "jp", "zh-cn", batchsize=10, jobs=3)
+    for name in names:
+        assert texts(tmp_path / f"{name}.zh-cn.srt") == [f"TR(line {i})" for i in range(30)]
+    # the files share the client, one request of each at a time
+    assert models.max_active == 3
+
+
+def test_stream_writes_in_order(tmp_path, monkeypatch):
+    # every pair of lines comes back swapped, and line 5 never does
+    models = Models(order=lambda n: [i ^ 1 if i ^ 1 < n else i for i in range(n)], drop={5})
+    src, out = tmp_path / "a.jp.srt", tmp_path / "a.zh-cn.srt"
+    write_source(src, 10)
+    seen = []
+    models.on_chunk = lambda: seen.append(texts(out) if out.exists() else [])
+    translator(monkeypatch, models, stream=True).translate_file(str(src), str(out), batchsize=10)
+    expected = [f"TR(line {i})" if i != 5 else "line 5" for i in range(10)]
+    assert texts(out) == expected
+    # the lines are written while the reply arrives, never before their translation
+    assert any(0 < len(s) < 10 for s in seen)
+    for s in seen:
+        assert s == expected[:len(s)]
+    assert max(len(s) for s in seen) <= 5
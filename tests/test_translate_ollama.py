@@ -0,0 +1,193 @@
+import asyncio
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import endpoints
+import srtfile
+import translate_ollama
+
+
+def parse_request(messages):
+    # the cues of a prompt, as made by Translator.make_prompt
+    return json.loads(re.search(r"(\[\s*\{.*\}\s*\])", messages[-1]["content"], re.S).group(1))
+
+
+def reply(request, drop=lambda text: False):
+    return json.dumps([{"id": r["id"], "content": f"TR({r['content']})"} for r in request if not drop(r["content"])],
+                      ensure_ascii=False)
+
+
+class StubEndpoint(endpoints.Endpoint):
+    """Answers in-process after `delay` seconds, every line as "TR(line)".
+
+    A down endpoint fails every request and health check, one with `fail` set
+    only its first `fail` requests. The lines in `drop_once` are missing from
+    the first reply that has them, the ones in `drop` from all."""
+
+    def __init__(self, url, limit=1, delay=0.01, down=False, fail=0, drop_once=(), drop=()):
+        self.api = "stub"
+        self.url = url
+        self.limit = limit
+        self.inflight = 0
+        self.healthy = True
+        self.served = 0
+        self.failures = 0
+        self.delay = delay
+        self.down = down
+        self.fail = fail
+        self.drop_once = set(drop_once)
+        self.drop = set(drop)
+        self.active = 0
+        self.max_active = 0
+        # the ids of every request
+        self.requests = []
+
+    async def check(self, timeout=10):
+        self.healthy = not self.down
+        return self.healthy
+
+    async def chat(self, model, messages, schema):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.down or self.fail > 0:
+                self.fail -= 1
+                raise ConnectionError(f"{self.url} is down")
+            request = parse_request(messages)
+            self.requests.append([r["id"] for r in request])
+            self.served += 1
+
+            def dropped(text):
+                if text in self.drop_once:
+                    self.drop_once.discard(text)
+                    return True
+                return text in self.drop
+            return reply(request, dropped)
+        finally:
+            self.active -= 1
+
+
+def translate(tmp_path, stubs, n=60, **options):
+    with srtfile.SrtWriter(str(tmp_path / "ep.jp.srt")) as out:
+        for i in range(n):
+            out.write(srtfile.Cue(i + 1, i * 1000, i * 1000 + 500, f"line {i}"))
+    options = dict(dict(batchsize=5, use_cache=False, log=lambda message: None, progress=lambda *args: None), **options)
+    translator = translate_ollama.Translator(endpoints.EndpointPool(stubs), "m", "jp", "zh-cn", **options)
+    asyncio.run(translator.translate_files(str(tmp_path), ["ep"], "jp", "zh-cn"))
+    return [c.text for c in srtfile.read_srt(str(tmp_path / "ep.zh-cn.srt"))]
+
+
+def test_trim_history():
+    history = ["a" * 30, "b" * 30, "c" * 30]
+    # 11 tokens each: the oldest one kept is cut to the 3 tokens left
+    assert translate_ollama.trim_history(history, 25) == ["a" * 8, "b" * 30, "c" * 30]
+    assert translate_ollama.trim_history(history, 100) == history
+    assert translate_ollama.trim_history(history, 0) == []
+
+
+def test_pick_least_loaded():
+    a, b, c = StubEndpoint("a", limit=4), StubEndpoint("b", limit=2), StubEndpoint("c", limit=1)
+    pool = endpoints.EndpointPool([a, b, c])
+    a.inflight, b.inflight = 3, 1
+    assert pool.pick() is c
+    c.inflight = 1
+    assert pool.pick() is b
+    b.healthy = False
+    assert pool.pick() is a
+    a.inflight = 4
+    assert pool.pick() is None
+
+
+def test_parse_endpoint():
+    assert endpoints.parse_endpoint("http://kun:11434=2") == ("http://kun:11434", 2)
+    assert endpoints.parse_endpoint("http://kun:11434", 3) == ("http://kun:11434", 3)
+
+
+def test_least_loaded_routing(tmp_path):
+    a, b = StubEndpoint("a", limit=2, delay=0.05), StubEndpoint("b", limit=1, delay=0.05)
+    texts = translate(tmp_path, [a, b])
+    assert texts == [f"TR(line {i})" for i in range(60)]
+    # both endpoints are busy up to their limits, never beyond
+    assert (a.max_active, b.max_active) == (2, 1)
+    assert a.served + b.served == 12
+    assert a.served > b.served > 0
+
+
+def test_failover(tmp_path):
+    # answers its health checks, but not the requests
+    down, up = StubEndpoint("down", limit=2, fail=1000), StubEndpoint("up")
+    texts = translate(tmp_path, [down, up])
+    assert texts == [f"TR(line {i})" for i in range(60)]
+    # the failed endpoint is out of rotation until a health check finds it up
+    assert not down.healthy
+    assert down.failures >= 1
+    assert up.served == 12
+
+
+def test_all_endpoints_down(tmp_path):
+    a, b = StubEndpoint("a", down=True), StubEndpoint("b", down=True)
+    with pytest.raises(RuntimeError, match="None of the endpoints is reachable"):
+        translate(tmp_path, [a, b])
+
+
+def test_endpoint_back_after_failure(tmp_path):
+    # the only endpoint fails twice: it is checked right away instead of after check_interval
+    stub = StubEndpoint("a", fail=2)
+    assert translate(tmp_path, [stub], n=10) == [f"TR(line {i})" for i in range(10)]
+    assert stub.failures == 2
+    assert stub.healthy
+
+
+def test_repair(tmp_path):
+    stub = StubEndpoint("a", drop_once={"line 2", "line 3"}, drop={"line 7"})
+    texts = translate(tmp_path, [stub], n=10, repair_retries=2)
+    # a cue that is never translated keeps its original text
+    assert texts == [f"TR(line {i})" if i != 7 else "line 7" for i in range(10)]
+    # repairs only ask for the missing cues (the batches after them get smaller)
+    assert stub.requests[:2] == [[0, 1, 2, 3, 4], [2, 3]]
+    assert stub.requests[-2:] == [[7], [7]]
+    assert sorted(sum(stub.requests[2:-2], [])) == [5, 6, 7, 8, 9]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # an OpenAI-compatible server
+    def log_message(self, *args):
+        pass
+
+    def send(self, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send({"object": "list", "data": [{"id": "m", "object": "model", "created": 0, "owned_by": "stub"}]})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.send({"id": "x", "object": "chat.completion", "created": 0, "model": "m",
+                   "choices": [{"index": 0, "finish_reason": "stop",
+                                "message": {"role": "assistant", "content": reply(parse_request(body["messages"]))}}]})
+
+
+def test_openai_endpoint(tmp_path):
+    pytest.importorskip("openai")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        up = endpoints.Endpoint("openai", f"http://127.0.0.1:{server.server_port}/v1", 2)
+        # nothing listens on port 9 (discard)
+        down = endpoints.Endpoint("openai", "http://127.0.0.1:9/v1")
+        assert translate(tmp_path, [up, down], n=20) == [f"TR(line {i})" for i in range(20)]
+        assert (up.served, down.served) == (4, 0)
+        assert not down.healthy
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,31 @@
+import srtfile
+from translation_memory import TranslationMemory, fill, split_batch
+
+
+def cues(*texts):
+    return [(i, srtfile.Cue(i + 1, 0, 1, t)) for i, t in enumerate(texts)]
+
+
+def test_split_batch():
+    batch = cues("はい", "ＡＢＣ", "いいえ", "ABC", "はい", "known")
+    send, same = split_batch(batch, {5: "已知"})
+    # full-width letters are the same line, known lines are not sent
+    assert [idx for idx, _ in send] == [0, 1, 2]
+    assert same == {3: 1, 4: 0}
+
+
+def test_fill():
+    translated = {0: "是", 1: "ABC", 2: "不"}
+    assert fill(translated, {5: "已知"}, {3: 1, 4: 0}) == {0: "是", 1: "ABC", 2: "不", 3: "ABC", 4: "是", 5: "已知"}
+    # a line missing from the reply stays missing for its repeats too
+    assert fill({0: "是"}, {}, {3: 1}) == {0: "是"}
+
+
+def test_lookup_and_store(tmp_path):
+    memory = TranslationMemory(str(tmp_path / "memory.db"), fuzzy=0.8)
+    memory.store("jp", "zh-cn", [("ありがとうございます", "谢谢"), ("", "x")])
+    assert memory.lookup("jp", "zh-cn", " ありがとうございます ") == "谢谢"
+    assert memory.lookup("jp", "en", "ありがとうございます") is None
+    assert memory.lookup("jp", "zh-cn", "ありがとうございました") == "谢谢"
+    assert (memory.hits, memory.fuzzy_hits, memory.misses) == (1, 1, 1)
+    memory.close()
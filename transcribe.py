@@ -1,12 +1,24 @@
 import subprocess
 import os
-from typing import List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import google.generativeai as genai
 import tqdm
+import numpy as np
+import ratelimit
+import state_store
+import cache
+import srtfile
 import time
 import datetime
 import argparse
 import re
+import json
+import bisect
+import itertools
+import collections
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 def parse_timedelta(s):
     try:
@@ -26,81 +38,297 @@ def parse_timedelta_tuple_list(s):
         result.append((parse_timedelta(start), parse_timedelta(end)))
     return result
 
-def extract_mp3(ffmpeg_path: str, fullpath: str, tempdir: str, segment_sec: int):
+def detect_silence(ffmpeg_path: str, fullpath: str, tempdir: str, noise_db: int = -35, min_silence: float = 0.5) -> Tuple[List[Tuple[float, float]], float]:
+    """Returns the silent intervals (in seconds) and the duration of the media file.
+
+    The result of ffmpeg's silencedetect pass is cached in silence.json of the temp dir.
+    """
+    os.makedirs(tempdir, exist_ok=True)
+    cache_path = os.path.join(tempdir, "silence.json")
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding="utf-8") as f:
+            cached = json.load(f)
+        return [tuple(s) for s in cached["silences"]], cached["duration"]
+    print("Detecting silence")
+    ret = subprocess.run([ffmpeg_path, "-i", fullpath, "-vn", "-af", f"silencedetect=noise={noise_db}dB:d={min_silence}", "-f", "null", "-"],
+                         stdin=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, encoding="utf-8", errors="replace")
+    if ret.returncode != 0:
+        raise RuntimeError("ffmpeg returns " + str(ret.returncode))
+    silences = []
+    duration = 0.0
+    start = None
+    for line in ret.stderr.splitlines():
+        m = re.search(r"Duration: (\d+):(\d+):([\d.]+)", line)
+        if m and duration == 0:
+            duration = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+        m = re.search(r"silence_start: (-?[\d.]+)", line)
+        if m:
+            start = max(float(m.group(1)), 0.0)
+        m = re.search(r"silence_end: ([\d.]+)", line)
+        if m and start is not None:
+            silences.append((start, float(m.group(1))))
+            start = None
+    if start is not None:
+        silences.append((start, duration))
+    with open(cache_path, "w", encoding="utf-8") as f:
+        json.dump({"silences": silences, "duration": duration}, f)
+    return silences, duration
+
+def choose_cut_points(silences: List[Tuple[float, float]], duration: float, segment_sec: int, slack: float = 0.25) -> List[float]:
+    # cut in the middle of the latest silence within the last `slack` of each
+    # segment, so that no segment is longer than segment_sec
+    mids = sorted((s + e) / 2 for s, e in silences)
+    cuts = []
+    last = 0.0
+    while duration - last > segment_sec:
+        target = last + segment_sec
+        i = bisect.bisect_right(mids, target) - 1
+        cut = mids[i] if i >= 0 and mids[i] >= target - segment_sec * slack and mids[i] > last else target
+        cuts.append(cut)
+        last = cut
+    return cuts
+
+def segment_command(ffmpeg_path: str, fullpath: str, tempdir: str, segment_sec: int, cut_points: Optional[List[float]], segment_list: str) -> List[str]:
+    if cut_points:
+        split = ["-segment_times", ",".join(f"{t:.3f}" for t in cut_points)]
+    else:
+        split = ["-segment_time", str(segment_sec)]
+    return [ffmpeg_path, "-i", fullpath, "-vn", "-c:a", "libmp3lame", "-q:a", "8", "-f",
+            "segment", *split, "-reset_timestamps", "1",
+            "-segment_list", segment_list, "-segment_list_type", "csv", os.path.join(tempdir, "output_%03d.mp3")]
+
+def parse_segment_list_line(line: str) -> Tuple[str, float, float]:
+    name, start, end = line.strip().rsplit(",", 2)
+    return name, float(start), float(end)
+
+def extract_mp3(ffmpeg_path: str, fullpath: str, tempdir: str, segment_sec: int, cut_points: Optional[List[float]] = None):
     os.makedirs(tempdir, exist_ok=True)
-    ret = subprocess.run([ffmpeg_path, "-i", fullpath, "-vn", "-c:a", "libmp3lame", "-q:a", "8", "-f",
-                          "segment", "-segment_time", str(segment_sec), "-reset_timestamps", "1", os.path.join(tempdir, "output_%03d.mp3")])
+    list_path = os.path.join(tempdir, "segments.csv")
+    ret = subprocess.run(segment_command(ffmpeg_path, fullpath, tempdir, segment_sec, cut_points, list_path))
     if ret.returncode != 0:
         raise RuntimeError("ffmpeg returns " + str(ret.returncode))
+    store = state_store.SegmentStore(os.path.join(tempdir, "state.db"))
+    with open(list_path, encoding="utf-8") as f:
+        for idx, line in enumerate(filter(str.strip, f)):
+            _, start, end = parse_segment_list_line(line)
+            store.set_offset(idx, start, end)
+    store.close()
+
+def extract_segments(ffmpeg_path: str, fullpath: str, tempdir: str, segment_sec: int, cut_points: Optional[List[float]] = None) -> Iterator[Tuple[str, float, float]]:
+    """Like extract_mp3, but yields (path, start, end) of each segment as soon as ffmpeg closes it.
+
+    The segment muxer prints a list entry to stdout only after the segment is
+    complete, so a yielded file is safe to upload while ffmpeg keeps running.
+    """
+    os.makedirs(tempdir, exist_ok=True)
+    proc = subprocess.Popen(segment_command(ffmpeg_path, fullpath, tempdir, segment_sec, cut_points, "pipe:1"),
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, universal_newlines=True)
+    store = state_store.SegmentStore(os.path.join(tempdir, "state.db"))
+    try:
+        for idx, line in enumerate(filter(str.strip, proc.stdout)):
+            name, start, end = parse_segment_list_line(line)
+            store.set_offset(idx, start, end)
+            yield os.path.join(tempdir, os.path.basename(name)), start, end
+    except GeneratorExit:
+        proc.kill()
+        raise
+    finally:
+        store.close()
+    ret = proc.wait()
+    if ret != 0:
+        raise RuntimeError("ffmpeg returns " + str(ret))
+
+def plan_cut_points(ffmpeg_path: str, fullpath: str, tempdir: str, segment_sec: int) -> List[float]:
+    silences, duration = detect_silence(ffmpeg_path, fullpath, tempdir)
+    return choose_cut_points(silences, duration, segment_sec)
+
+def speech_ratio(silences: List[Tuple[float, float]], start: float, end: float) -> float:
+    # fraction of [start, end) that is not covered by a detected silence
+    if end <= start:
+        return 0.0
+    silent = 0.0
+    for s, e in silences:
+        if e > start and s < end:
+            silent += min(e, end) - max(s, start)
+    return max(0.0, 1.0 - silent / (end - start))
+
+def segment_span(offsets: Dict[int, Tuple[float, float]], idx: int, segment_sec: int) -> Tuple[float, float]:
+    # real position of a segment if extract recorded it, otherwise the nominal one
+    if idx in offsets:
+        return offsets[idx]
+    return idx * segment_sec, (idx + 1) * segment_sec
 
 skip_filename = "@SKIP@"
-def upload(tempdir: str, segment_sec: int, time_ranges: List[Tuple[datetime.timedelta, datetime.timedelta]]) -> List[str]:
-    print("Uploading")
-    files = []
-    for file in os.listdir(tempdir):
-        if file.startswith("output_") and file.endswith(".mp3"):
-            files.append(os.path.join(tempdir, file))
-    files = sorted(files)
+
+def in_time_ranges(time_ranges: List[Tuple[datetime.timedelta, datetime.timedelta]], s: datetime.timedelta, e: datetime.timedelta) -> bool:
+    if len(time_ranges) == 0:
+        return True
+    for rst, rend in time_ranges:
+        if s <= rend and e >= rst:
+            return True
+    return False
+
+def read_uri_file(uripath: str) -> List[str]:
     uri = []
-    uripath = os.path.join(tempdir, "uri.txt")
     if os.path.exists(uripath):
         with open(uripath, 'r') as f:
             for line in f:
                 line = line.strip()
                 if len(line):
                     uri.append(line)
-    bar = tqdm.tqdm(files[len(uri):])
-    cur = datetime.timedelta(seconds=len(uri)*segment_sec)
-    def in_ranges(s: datetime.timedelta, e: datetime.timedelta):
-        if len(time_ranges) == 0:
-            return True
-        for rst, rend in time_ranges:
-            if s <= rend and e >= rst:
-                return True
+    return uri
+
+def upload_segment(file: str, upload_cache: Optional[cache.UploadCache] = None) -> str:
+    if upload_cache is not None:
+        digest = cache.file_digest(file)
+        name = upload_cache.lookup(digest)
+        if name is not None:
+            # the remote file may have been deleted before its expiration time
+            try:
+                if genai.get_file(name).state.name == "ACTIVE":
+                    return name
+            except Exception:
+                pass
+            upload_cache.forget(digest)
+    sample_file = genai.upload_file(path=file,
+                                    mime_type="audio/mp3")
+
+    while sample_file.state.name == "PROCESSING":
+        time.sleep(3)
+        sample_file = genai.get_file(sample_file.name)
+
+    if sample_file.state.name == "FAILED":
+        raise ValueError(sample_file.state.name)
+    if upload_cache is not None:
+        expiration = getattr(sample_file, "expiration_time", None)
+        expires = expiration.timestamp() if expiration else time.time() + 47 * 3600
+        upload_cache.store(digest, sample_file.name, expires)
+    return sample_file.name
+
+def should_upload(time_ranges: List[Tuple[datetime.timedelta, datetime.timedelta]], silences: Optional[List[Tuple[float, float]]], min_speech: float, st: float, ed: float) -> bool:
+    if not in_time_ranges(time_ranges, datetime.timedelta(seconds=st), datetime.timedelta(seconds=ed)):
         return False
+    if silences is not None and min_speech > 0 and speech_ratio(silences, st, ed) < min_speech:
+        return False
+    return True
 
-    with open(uripath, "a") as f:
-        for file in bar:
-            if not in_ranges(cur, cur + datetime.timedelta(seconds=segment_sec)):
-                f.write(skip_filename+"\n")
-                uri.append(skip_filename)
-                cur += datetime.timedelta(seconds=segment_sec)
-                continue
-            bar.set_description(os.path.basename(file))
-            sample_file = genai.upload_file(path=file,
-                                            mime_type="audio/mp3")
-
-            while sample_file.state.name == "PROCESSING":
-                time.sleep(3)
-                sample_file = genai.get_file(sample_file.name)
-
-            if sample_file.state.name == "FAILED":
-                raise ValueError(sample_file.state.name)
-            f.write(sample_file.name+"\n")
-            uri.append(sample_file.name)
-            cur += datetime.timedelta(seconds=segment_sec)
+def upload(tempdir: str, segment_sec: int, time_ranges: List[Tuple[datetime.timedelta, datetime.timedelta]], workers: int = 4,
+           silences: Optional[List[Tuple[float, float]]] = None, min_speech: float = 0, upload_cache: Optional[cache.UploadCache] = None) -> List[str]:
+    print("Uploading")
+    files = []
+    for file in os.listdir(tempdir):
+        if file.startswith("output_") and file.endswith(".mp3"):
+            files.append(os.path.join(tempdir, file))
+    files = sorted(files)
+    uripath = os.path.join(tempdir, "uri.txt")
+    uri = read_uri_file(uripath)
+    store = state_store.SegmentStore(os.path.join(tempdir, "state.db"))
+    offsets = store.offsets()
+    store.close()
+    bar = tqdm.tqdm(total=len(files) - len(uri))
+
+    # uploads and the PROCESSING polls run in the pool, but uri.txt is still
+    # written in segment order so that a resumed run can trust its prefix
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool, open(uripath, "a") as f:
+        futures = []
+        for idx in range(len(uri), len(files)):
+            st, ed = segment_span(offsets, idx, segment_sec)
+            if not should_upload(time_ranges, silences, min_speech, st, ed):
+                futures.append(None)
+            else:
+                futures.append(pool.submit(upload_segment, files[idx], upload_cache))
+        for idx, fut in enumerate(futures, len(uri)):
+            bar.set_description(os.path.basename(files[idx]))
+            name = skip_filename if fut is None else fut.result()
+            f.write(name+"\n")
+            f.flush()
+            uri.append(name)
+            bar.update(1)
     return uri
 
 
+def stream_upload(tempdir: str, time_ranges: List[Tuple[datetime.timedelta, datetime.timedelta]], segments: Iterable[Tuple[str, float, float]], workers: int = 4,
+                  silences: Optional[List[Tuple[float, float]]] = None, min_speech: float = 0, upload_cache: Optional[cache.UploadCache] = None) -> Iterator[str]:
+    """Streaming version of upload: uploads (path, start, end) segments as they
+    are produced and yields the remote names in segment order as soon as they
+    are ACTIVE."""
+    print("Uploading (streaming)")
+    uripath = os.path.join(tempdir, "uri.txt")
+    uri = read_uri_file(uripath)
+    pending = queue.Queue()
+    pool = ThreadPoolExecutor(max_workers=max(workers, 1))
+
+    def produce():
+        try:
+            for idx, (file, st, ed) in enumerate(segments):
+                if idx < len(uri):
+                    pending.put(uri[idx])
+                elif not should_upload(time_ranges, silences, min_speech, st, ed):
+                    pending.put(skip_filename)
+                else:
+                    pending.put(pool.submit(upload_segment, file, upload_cache))
+            pending.put(None)
+        except Exception as e:
+            pending.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    with pool, open(uripath, "a") as f:
+        for idx in itertools.count():
+            item = pending.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            name = item.result() if isinstance(item, Future) else item
+            if idx >= len(uri):
+                f.write(name+"\n")
+                f.flush()
+            yield name
+
+def stream_extract_and_upload(fullpath: str, tempdir: str, ffmpeg_path: str, segment_sec: int, time_ranges: List[Tuple[datetime.timedelta, datetime.timedelta]], upload_workers: int = 4,
+                              silence_split: bool = False, min_speech: float = 0, upload_cache: Optional[cache.UploadCache] = None) -> Iterator[str]:
+    # uri.txt is opened before ffmpeg gets to make the directory
+    os.makedirs(tempdir, exist_ok=True)
+    cut_points = plan_cut_points(ffmpeg_path, fullpath, tempdir, segment_sec) if silence_split else None
+    silences = detect_silence(ffmpeg_path, fullpath, tempdir)[0] if min_speech > 0 else None
+    segments = extract_segments(ffmpeg_path, fullpath, tempdir, segment_sec, cut_points)
+    return stream_upload(tempdir, time_ranges, segments, upload_workers, silences, min_speech, upload_cache)
+
 def cleanup_timestamp(s: str) -> str:
     return "\n".join(filter(lambda x: not x.startswith("[["), s.split("\n")))
 
-def extract_and_upload(fullpath: str, tempdir: str, ffmpeg_path: str, segment_sec: int, skip_extract: bool, time_ranges: List[Tuple[datetime.timedelta, datetime.timedelta]]) -> List[str]:
+def complete_blocks(text: str) -> str:
+    # the blocks of a streamed response before the last "[[" are complete
+    end = text.rfind("[[")
+    return text[:end] if end > 0 else ""
+
+def chunk_text(chunk) -> str:
+    try:
+        return chunk.text
+    except ValueError:
+        # a chunk without text, e.g. the one only carrying the finish reason
+        return ""
+
+def continue_prompt(prompt_parts, done: str):
+    # asks for the rest of the audio after the blocks already received
+    if not done:
+        return prompt_parts
+    stamps = re.findall(r"\[\[\s*(\d+:\d+)\s*~\s*(\d+:\d+)", done)
+    end = stamps[-1][1] if stamps else "00:00"
+    return {"role": "user", "parts": prompt_parts["parts"] + [
+        f"The audio until {end} is already transcribed as below:\n{done}\nContinue the transcription from {end}. Do not repeat the transcription above."]}
+
+def extract_and_upload(fullpath: str, tempdir: str, ffmpeg_path: str, segment_sec: int, skip_extract: bool, time_ranges: List[Tuple[datetime.timedelta, datetime.timedelta]], upload_workers: int = 4,
+                       silence_split: bool = False, min_speech: float = 0, upload_cache: Optional[cache.UploadCache] = None) -> List[str]:
     if not skip_extract:
-        extract_mp3(ffmpeg_path, fullpath, tempdir, segment_sec)
-    return upload(tempdir, segment_sec, time_ranges)
+        cut_points = plan_cut_points(ffmpeg_path, fullpath, tempdir, segment_sec) if silence_split else None
+        extract_mp3(ffmpeg_path, fullpath, tempdir, segment_sec, cut_points)
+    silences = detect_silence(ffmpeg_path, fullpath, tempdir)[0] if min_speech > 0 else None
+    return upload(tempdir, segment_sec, time_ranges, upload_workers, silences, min_speech, upload_cache)
 
 log_split_line = "!!!!!!!!!=================!!!!!!!!!!!!\n"
 role_user = "ROLE=user,"
 role_model = "ROLE=model,"
-def record_transcribe_prompt(logf, file : genai.types.File):
-    name = skip_filename if file is None else file.name
-    logf.write(f"{log_split_line}{role_user}{name}\n")
-
-def record_transcribe_result(logf, content : genai.types.GenerateContentResponse):
-    cont = skip_filename if content is None else str(content.text)
-    logf.write(f"{log_split_line}ROLE=model,{cont}\n")
-
 def recover_from_transcribe_result(path) -> Tuple[List[dict], List[str]]:
     prompt_parts = []
     responds = []
@@ -127,7 +355,14 @@ def recover_from_transcribe_result(path) -> Tuple[List[dict], List[str]]:
 
     return prompt_parts, responds
 
-def transcribe(tempdir: str, uris: List[str], segment: int, hint: str):
+def migrate_state_file(path: str, store: state_store.SegmentStore):
+    # state.txt of older versions only holds the responses, in segment order
+    _, responses = recover_from_transcribe_result(path)
+    for idx, response in enumerate(responses):
+        store.save_result(idx, "", response)
+
+def transcribe(tempdir: str, uris: Iterable[str], segment: int, hint: str, limiter: Optional[ratelimit.RateLimiter] = None, parallel: int = 1,
+               response_cache: Optional[cache.ResponseCache] = None, stream: bool = False):
     # Set up the model
     generation_config = {
         "temperature": 1,
@@ -205,50 +440,119 @@ Example output:
     if hint:
         system_instruction += "More hints on the contents:" + hint
     print("Translating")
-    model = genai.GenerativeModel(model_name="gemini-2.0-flash",
+    if limiter is None:
+        limiter = ratelimit.RateLimiter()
+    model_name = "gemini-2.0-flash"
+    model = genai.GenerativeModel(model_name=model_name,
                                   generation_config=generation_config,
                                   system_instruction=system_instruction,
                                   safety_settings=safety_settings)
-    prompt_parts = []
-    responses = []
+    store = state_store.SegmentStore(os.path.join(tempdir, "state.db"))
     state_file_path = os.path.join(tempdir, "state.txt")
-    if os.path.exists(state_file_path):
-        print("Found state file of previous run. Resuming...")
-        prompt_parts, responses = recover_from_transcribe_result(state_file_path)
-        print("Continue from part", len(responses))
-    last_result = "(None)" if len(responses) == 0 else cleanup_timestamp(responses[-1])
-    bar = tqdm.tqdm(uris[len(responses):])
-    with open(state_file_path, 'a', encoding="utf-8") as outf:
-        for uri in bar:
-            if uri == skip_filename:
-                record_transcribe_prompt(outf, None)
-                record_transcribe_result(outf, None)
-                responses.append("")
-                outf.flush()
-                continue
-            file = genai.get_file(uri)
-            prompt_parts = {"role": "user", "parts": ["Previous context that may be related to the next audio:\n" + last_result + "\nPlease transcribe the following audio:", file] if last_result else [file]}
-            for retries in range(6):
-                try:
+    if not store.has_results() and os.path.exists(state_file_path):
+        print("Importing state.txt of previous run...")
+        migrate_state_file(state_file_path, store)
+    done = store.responses()
+    if done:
+        print("Found state of previous run. Resuming,", len(done), "parts done")
+    # complete blocks of streamed responses cut short by the previous run
+    partials = store.partials() if stream else {}
+    last_result = "(None)"
+
+    def transcribe_segment(idx: int, uri: str, context: str) -> str:
+        started = time.time()
+        if response_cache is not None:
+            # the remote name changes with every upload, so the audio is keyed by its content
+            audio = os.path.join(tempdir, f"output_{idx:03d}.mp3")
+            audio_key = cache.file_digest(audio) if os.path.exists(audio) else uri
+            cache_key = response_cache.make_key(model_name, system_instruction, [context, audio_key], generation_config)
+            text = response_cache.get(cache_key)
+            if text is not None:
+                store.save_result(idx, uri, text, 0, 0, started, time.time() - started)
+                return text
+        file = genai.get_file(uri)
+        prompt_parts = {"role": "user", "parts": ["Previous context that may be related to the next audio:\n" + context + "\nPlease transcribe the following audio:", file] if context else [file]}
+        # audio is billed at 32 tokens per second
+        est_tokens = segment * 32 + ratelimit.estimate_tokens(system_instruction + context)
+        received = partials.get(idx, "")
+        for retries in range(6):
+            try:
+                limiter.acquire(est_tokens)
+                if not stream:
                     response = model.generate_content(prompt_parts, request_options={"timeout": 600})
-                    last_result = cleanup_timestamp(response.text)
-                    time.sleep(5)
+                    text = response.text
                     break
-                except Exception as e:
-                    if retries == 5:
-                        raise e
-                    print(f"Error!!!!!!!!!!!!!!{e}\\nsleeping")
-                    if " An internal error has occurred." in str(e):
-                        time.sleep(20)
-                    else:
-                        time.sleep(60)
-            # print(response.text)
-            record_transcribe_prompt(outf, file)
-            record_transcribe_result(outf, response)
-            responses.append(response.text)
-            # print(response.candidates[0].content)
-            outf.flush()
-            time.sleep(50)
+                # every complete block is saved as it arrives, and a retry only asks for the rest
+                if received and not received.endswith("\n"):
+                    received += "\n"
+                response = model.generate_content(continue_prompt(prompt_parts, received), stream=True, request_options={"timeout": 600})
+                text = received
+                for chunk in response:
+                    text += chunk_text(chunk)
+                    blocks = complete_blocks(text)
+                    if len(blocks) > len(received):
+                        received = blocks
+                        store.save_partial(idx, uri, received)
+                break
+            except Exception as e:
+                if retries == 5:
+                    raise e
+                print(f"Error!!!!!!!!!!!!!!{e}\\nsleeping")
+                limiter.backoff(retries, e)
+        usage = getattr(response, "usage_metadata", None)
+        limiter.record_usage(est_tokens, getattr(usage, "total_token_count", None) or 0)
+        if response_cache is not None:
+            response_cache.put(cache_key, text)
+        # committed right away, so segments may complete out of order
+        store.save_result(idx, uri, text, getattr(usage, "prompt_token_count", None) or 0,
+                          getattr(usage, "candidates_token_count", None) or 0, started, time.time() - started)
+        return text
+
+    # Up to `parallel` segments are in flight. A segment is seeded with the
+    # transcription of the closest preceding segment that has already finished
+    # (with parallel=1 that is always the previous one).
+    window = collections.deque()
+
+    def latest_context() -> str:
+        for fut in reversed(window):
+            if fut.done() and fut.exception() is None and fut.result():
+                return cleanup_timestamp(fut.result())
+        return last_result
+
+    def flush_head():
+        nonlocal last_result
+        text = window.popleft().result()
+        if text:
+            last_result = cleanup_timestamp(text)
+        bar.update(1)
+
+    # uris may be a lazy stream from stream_extract_and_upload
+    total = len(uris) - len(done) if isinstance(uris, list) else None
+    bar = tqdm.tqdm(total=total)
+    parallel = max(parallel, 1)
+    num_segments = 0
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        for idx, uri in enumerate(uris):
+            num_segments = idx + 1
+            if idx in done:
+                if done[idx]:
+                    last_result = cleanup_timestamp(done[idx])
+                continue
+            while len(window) >= parallel:
+                flush_head()
+            if uri == skip_filename:
+                store.save_result(idx, uri, "")
+                bar.update(1)
+            else:
+                window.append(pool.submit(transcribe_segment, idx, uri, latest_context()))
+        while window:
+            flush_head()
+    bar.close()
+    if response_cache is not None:
+        print(response_cache.stats())
+    done = store.responses()
+    store.close()
+    responses = [done.get(idx, "") for idx in range(num_segments)]
 
     with open(os.path.join(tempdir, "raw.txt"), 'w', encoding="utf-8") as outf:
         for response in responses:
@@ -261,42 +565,28 @@ Example output:
             outf.write("\n=============================\n")
 
 def convert(video_path: str, tempdir: str, segment: int, lang: str):
-    curtime = datetime.datetime.combine(
-        datetime.datetime.today().date(), datetime.time(0, 0, 0))
+    store = state_store.SegmentStore(os.path.join(tempdir, "state.db"))
+    offsets = store.offsets()
+    store.close()
+    # the cues as read from raw.txt, in integer milliseconds relative to their segment
+    seg_ids: List[int] = []
+    starts: List[int] = []
+    ends: List[int] = []
+    texts: List[str] = []
     conversations = []
-    segments : List[Tuple[datetime.datetime, List[List[datetime.timedelta, datetime.timedelta, str]]]] = [(curtime, [])]
+    seg = 0
+    st = ed = 0
     def push_conversation():
         nonlocal conversations
         if len(conversations) == 0:
             return
-        nonlocal st, ed
-        conversations = " ".join(conversations).replace(
-            "\t", " ").replace("\xa0", " ").split(" ")
-        delta = ed - st
-        totallen = len("".join(conversations))
-        if totallen == 0:
-            totallen = 1
-        if totallen > 3100:
-            '''# split the long sentence by the " "
-            time_step = delta/totallen
-            cur_start = st
-            for didx, d in enumerate(conversations):
-                if len(d.strip()) == 0:
-                    continue
-                mystart = cur_start
-                myend = cur_start + time_step * len(d)
-                cur_start = myend
-                results.append(
-                    f"{mystart.hour:02d}:{mystart.minute:02d}:{mystart.second:02d},{int(mystart.microsecond/1000.0):03d} --> {myend.hour:02d}:{myend.minute:02d}:{myend.second:02d},{int(myend.microsecond/1000.0):03d}\n{d}\n")
-            '''
-        else:
-            mystart = st
-            myend = ed
-            d = " ".join(conversations)
-            segments[-1][1].append([mystart, myend, d])
-            # results.append(f"{mystart.hour:02d}:{mystart.minute:02d}:{mystart.second:02d},000 --> {myend.hour:02d}:{myend.minute:02d}:{myend.second:02d},000\n{d}\n")
-        # d = "\n".join(conversations)
-        # results.append(f"{st.hour:02d}:{st.minute:02d}:{st.second:02d},000 --> {ed.hour:02d}:{ed.minute:02d}:{ed.second:02d},000\n{d}\n")
+        d = " ".join(conversations).replace("\t", " ").replace("\xa0", " ")
+        # overly long blocks are garbage produced by the model, drop them
+        if len(d.replace(" ", "")) <= 3100:
+            seg_ids.append(seg)
+            starts.append(st)
+            ends.append(ed)
+            texts.append(d)
         conversations = []
     with open(os.path.join(tempdir, "raw.txt"), 'r', encoding="utf-8") as infile:
         for line in infile:
@@ -306,69 +596,57 @@ def convert(video_path: str, tempdir: str, segment: int, lang: str):
                 continue
             if "=========" in line:
                 push_conversation()
-                curtime += datetime.timedelta(seconds=segment)
-                segments.append((curtime, []))
+                seg += 1
             elif "[[" in line and "~" in line:
                 try:
                     push_conversation()
                     start_time, end_time = line[2:].split("~")
                     st_spl = start_time.split(":")
                     ed_spl = end_time.split(":")
-                    st = datetime.timedelta(minutes=int(
-                        st_spl[0]), seconds=int(st_spl[1]))
-                    ed = datetime.timedelta(minutes=int(
-                        ed_spl[0]), seconds=int(ed_spl[1]))
+                    st = (int(st_spl[0]) * 60 + int(st_spl[1])) * 1000
+                    ed = (int(ed_spl[0]) * 60 + int(ed_spl[1])) * 1000
                 except Exception as e:
                     print("Error when parsing line: ", line)
                     raise e
             else:
                 conversations.append(line)
         push_conversation()
-    # adjust the segment offsets
-    results: List[List[datetime.datetime, datetime.datetime, str]] = []
-    for seg_start, conv in segments:
-        if len(conv) == 0:
-            continue
-        _, last_ed, _ = conv[-1]
-        scale = 1
-        if last_ed.seconds > segment:
-            scale = segment / last_ed.seconds
-        for st, ed, d in conv:
-            results.append([st*scale+seg_start, ed*scale+seg_start, d])
-    # adjust start timestamps
-    idx = 0
-    while idx < len(results):
-        st, _, _ = results[idx]
-        nidx = idx + 1
-        # find equal range of st
-        while nidx < len(results):
-            st2, _, _ = results[nidx]
-            if st2 != st:
-                 break
-            nidx += 1
-        if nidx == idx + 1:
-            idx = nidx
-            continue
-        nequal = nidx - idx
-        delta = datetime.timedelta(seconds=1/nequal)
-        for i in range(idx, nidx):
-            results[i][0] = st + delta * (i - idx)
-        idx = nidx
-    # adjust end timestamps
-    for idx, (st, ed, _) in enumerate(results):
-        if idx > 0:
-            _, last_ed, _ = results[idx-1]
-            if st < last_ed:
-                results[idx-1][1] = st
-        if ed <= st:
-            results[idx][1] = st + datetime.timedelta(seconds=0.5)
+    seg_ids = np.asarray(seg_ids, dtype=np.int64)
+    st = np.asarray(starts, dtype=np.int64)
+    ed = np.asarray(ends, dtype=np.int64)
+    if len(st):
+        # adjust the segment offsets: shrink a segment whose last cue ends
+        # after the segment itself, then move it to the real segment start
+        # the adjusted times are rounded to microseconds, like the datetime arithmetic
+        # of older versions, and cut to milliseconds at the end
+        spans = np.array([segment_span(offsets, i, segment) for i in range(seg + 1)], dtype=np.float64)
+        seg_start = np.rint(spans[:, 0] * 1_000_000).astype(np.int64)
+        seg_len = spans[:, 1] - spans[:, 0]
+        last = np.flatnonzero(np.r_[seg_ids[1:] != seg_ids[:-1], True])
+        last_ed = np.zeros(seg + 1, dtype=np.int64)
+        last_ed[seg_ids[last]] = ed[last] // 1000
+        scale = np.where(last_ed > seg_len, seg_len / np.maximum(last_ed, 1), 1.0)[seg_ids]
+        st = np.rint(st * 1000 * scale).astype(np.int64) + seg_start[seg_ids]
+        ed = np.rint(ed * 1000 * scale).astype(np.int64) + seg_start[seg_ids]
+        # adjust start timestamps: spread a run of equal starts over one second
+        run_head = np.r_[True, st[1:] != st[:-1]]
+        run_id = np.cumsum(run_head) - 1
+        first = np.flatnonzero(run_head)
+        run_len = np.diff(np.r_[first, len(st)])
+        rank = np.arange(len(st)) - first[run_id]
+        st = st + rank * np.rint(1_000_000 / run_len[run_id]).astype(np.int64)
+        # adjust end timestamps: no empty cues, and no overlap with the next cue
+        ed = np.where(ed <= st, st + 500_000, ed)
+        ed[:-1] = np.minimum(ed[:-1], st[1:])
+        st //= 1000
+        ed //= 1000
 
     outpathspl = video_path.split(".")
     outpathspl[-1] = lang + ".srt"
     outpath = ".".join(outpathspl)
-    with open(outpath, 'w', encoding="utf-8-sig") as outf:
-        for idx, (mystart, myend, d) in enumerate(results):
-            outf.write(f"{idx+1}\n{mystart.hour:02d}:{mystart.minute:02d}:{mystart.second:02d},{int(mystart.microsecond/1000.0):03d} --> {myend.hour:02d}:{myend.minute:02d}:{myend.second:02d},{int(myend.microsecond/1000.0):03d}\n{d}\n\n")
+    with srtfile.SrtWriter(outpath) as outf:
+        for idx, (mystart, myend, d) in enumerate(zip(st.tolist(), ed.tolist(), texts)):
+            outf.write(srtfile.Cue(idx+1, mystart, myend, d))
 
 
 if __name__ == "__main__":
@@ -385,6 +663,15 @@ if __name__ == "__main__":
         "--lang", type=str, default="jp")
     parser.add_argument('--times', type=parse_timedelta_tuple_list, help='List of time intervals in the format "hh:mm:ss-hh:mm:ss,hh:mm:ss-hh:mm:ss"', default=[])
     parser.add_argument("--hint", type=str, default="")
+    parser.add_argument("--upload-workers", type=int, default=4, help="number of segments uploaded concurrently")
+    parser.add_argument("--rpm", type=float, default=10, help="requests per minute allowed by the API key, 0 for unlimited")
+    parser.add_argument("--tpm", type=float, default=0, help="tokens per minute allowed by the API key, 0 for unlimited")
+    parser.add_argument("--parallel", type=int, default=1, help="number of segments transcribed concurrently")
+    parser.add_argument("--silence-split", action="store_true", default=False, help="cut segments at silences close to the segment length")
+    parser.add_argument("--min-speech", type=float, default=0, help="skip segments whose non-silent fraction is below this value, e.g. 0.05")
+    parser.add_argument("--no-cache", action="store_true", default=False, help="do not reuse files uploaded or responses received by previous runs")
+    parser.add_argument("--stream", action="store_true", default=False, help="upload and transcribe each segment as soon as ffmpeg finishes it")
+    parser.add_argument("--stream-response", action="store_true", default=False, help="receive the transcription as it is generated and keep what arrived if a request fails")
     args = parser.parse_args()
     genai.configure(api_key=args.key,  transport="rest")
     video_path = args.path
@@ -393,7 +680,13 @@ if __name__ == "__main__":
     tempdir = fullpath + ".dir"
 
     if not args.skip_transcribe:
-        uri = extract_and_upload(
-            fullpath, tempdir, args.ffmpeg, args.segment, args.skip_extract, args.times)
-        transcribe(tempdir, uri, args.segment, args.hint)
+        upload_cache = None if args.no_cache else cache.UploadCache()
+        if args.stream and not args.skip_extract:
+            uri = stream_extract_and_upload(
+                fullpath, tempdir, args.ffmpeg, args.segment, args.times, args.upload_workers, args.silence_split, args.min_speech, upload_cache)
+        else:
+            uri = extract_and_upload(
+                fullpath, tempdir, args.ffmpeg, args.segment, args.skip_extract, args.times, args.upload_workers, args.silence_split, args.min_speech, upload_cache)
+        response_cache = None if args.no_cache else cache.ResponseCache()
+        transcribe(tempdir, uri, args.segment, args.hint, ratelimit.RateLimiter(args.rpm, args.tpm), args.parallel, response_cache, args.stream_response)
     convert(video_path, tempdir, args.segment, args.lang)
@@ -1,33 +1,349 @@
-
 import argparse
-from subsai import SubsAI
+import io
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import time
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from tqdm import tqdm
+
+import srtfile
+
+vad_parameters = {
+    "min_speech_duration_ms": 250,
+    "max_speech_duration_s": float("inf"),
+    "min_silence_duration_ms": 2000,
+    "speech_pad_ms": 400,
+}
+
+sampling_rate = 16000
+
+
+def write_srt(path, segments):
+    # segments of (start, end, text) in seconds, from one or many chunks
+    with srtfile.SrtWriter(path) as out:
+        for i, (start, end, text) in enumerate(sorted(segments), 1):
+            out.write(srtfile.Cue(i, round(start * 1000), round(end * 1000), text.strip()))
+
+
+class SubsAITranscriber:
+    """The whole file in one SubsAI call."""
+
+    def __init__(self, device, compute_type, cpu_threads=0, num_workers=1):
+        from subsai import SubsAI
+        self.subs_ai = SubsAI()
+        self.model = self.subs_ai.create_model('guillaumekln/faster-whisper', {'model_size_or_path': 'large-v3', 'device': device, "compute_type": compute_type, "language": "ja", "suppress_blank": True, "vad_filter": True,
+                                                                               "vad_parameters": vad_parameters,
+                                                                               "cpu_threads": cpu_threads, "num_workers": num_workers,
+                                                                               })  # ,
+
+    def transcribe(self, file, out, progress=None):
+        subs = self.subs_ai.transcribe(file, self.model)
+        subs.save(out)
+
+
+class BatchedTranscriber:
+    """faster-whisper's batched inference: the VAD chunks of a file are decoded `batch_size` at a time."""
+
+    def __init__(self, device, compute_type, cpu_threads=0, num_workers=1, batch_size=16, chunk_length=30):
+        from faster_whisper import BatchedInferencePipeline, WhisperModel
+        model = WhisperModel('large-v3', device=device, compute_type=compute_type, cpu_threads=cpu_threads, num_workers=num_workers)
+        self.pipeline = BatchedInferencePipeline(model=model)
+        self.batch_size = batch_size
+        self.chunk_length = chunk_length
+
+    def transcribe(self, file, out, progress=None):
+        # a batch is made of chunks of at most chunk_length seconds
+        segments, info = self.pipeline.transcribe(file, language="ja", suppress_blank=True, batch_size=self.batch_size, chunk_length=self.chunk_length,
+                                                  vad_filter=True, vad_parameters=dict(vad_parameters, max_speech_duration_s=self.chunk_length))
+        result = []
+        for s in segments:
+            result.append((s.start, s.end, s.text))
+            if progress is not None:
+                # seconds of the audio done
+                progress(os.path.basename(file), int(s.end), int(info.duration))
+        write_srt(out, result)
+
+
+# the model of a process of ChunkedTranscriber
+chunk_model = None
+
+
+def load_chunk_model(compute_type, cpu_threads):
+    global chunk_model
+    from faster_whisper import WhisperModel
+    chunk_model = WhisperModel('large-v3', device='cpu', compute_type=compute_type, cpu_threads=cpu_threads)
+
+
+def chunk_model_pid():
+    return os.getpid()
+
+
+def transcribe_chunk(offset, audio):
+    segments, info = chunk_model.transcribe(audio, language="ja", suppress_blank=True, vad_filter=True, vad_parameters=vad_parameters)
+    return [(offset + s.start, offset + s.end, s.text) for s in segments]
+
+
+def split_chunks(speech, chunk_length):
+    """Groups the speech of the VAD (sample offsets) into chunks of at most
+    chunk_length seconds, cut in the silences between speech."""
+    chunks = []
+    for ts in speech:
+        if chunks and ts['end'] - chunks[-1][0] <= chunk_length * sampling_rate:
+            chunks[-1][1] = ts['end']
+        else:
+            chunks.append([ts['start'], ts['end']])
+    return chunks
+
+
+class ChunkedTranscriber:
+    """The VAD chunks of a file run in `workers` processes, each with its own model on the CPU."""
+
+    def __init__(self, compute_type, workers, cpu_threads=0, chunk_length=60):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # share the cores between the processes
+        cpu_threads = cpu_threads or max(1, (os.cpu_count() or 1) // workers)
+        # spawned like on Windows, so the processes do not inherit the socket of --serve
+        self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=load_chunk_model, initargs=(compute_type, cpu_threads))
+        self.chunk_length = chunk_length
+        # start every process now, so the models are loaded before the first file
+        for future in [self.pool.submit(chunk_model_pid) for _ in range(workers)]:
+            future.result()
+
+    def transcribe(self, file, out, progress=None):
+        from faster_whisper import decode_audio
+        from faster_whisper.vad import VadOptions, get_speech_timestamps
+        audio = decode_audio(file, sampling_rate=sampling_rate)
+        speech = get_speech_timestamps(audio, VadOptions(**dict(vad_parameters, max_speech_duration_s=self.chunk_length)))
+        chunks = split_chunks(speech, self.chunk_length)
+        print(f"{len(chunks)} chunks")
+        futures = [self.pool.submit(transcribe_chunk, start / sampling_rate, audio[start:end]) for start, end in chunks]
+        segments = []
+        for n, future in enumerate(tqdm(futures, desc="chunks", disable=progress is not None), 1):
+            segments += future.result()
+            if progress is not None:
+                progress(os.path.basename(file), n, len(futures))
+        write_srt(out, segments)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--base', type=str, default='D:\\Temp', help='视频文件所在目录')
-parser.add_argument('--files', nargs='+', required=True, help='视频文件名列表（不带扩展名）')
-parser.add_argument('--video_ext', type=str, default='mp4', help='视频扩展名')
-args = parser.parse_args()
 
-subs_ai = SubsAI()
-base = args.base
-files = args.files
-video_ext = args.video_ext
+def load_model(device='cuda', compute_type=None, batched=False, cpu_workers=0, cpu_threads=0, num_workers=1,
+               batch_size=16, chunk_length=None):
+    """Loads faster-whisper once, returns the transcriber for transcribe_file."""
+    if cpu_workers > 1:
+        # the chunks always run on the CPU
+        device = 'cpu'
+    if compute_type is None:
+        compute_type = 'float16' if device == 'cuda' else 'int8'
+    if cpu_workers > 1:
+        return ChunkedTranscriber(compute_type, cpu_workers, cpu_threads, chunk_length or 60)
+    if batched:
+        return BatchedTranscriber(device, compute_type, cpu_threads, num_workers, batch_size, chunk_length or 30)
+    return SubsAITranscriber(device, compute_type, cpu_threads, num_workers)
 
 
-def transcribe(name):
-    file = f'{base}\\{name}.{video_ext}'
+def transcribe_file(model, base, name, video_ext='mp4', progress=None):
+    """Writes {base}/{name}.jp.srt. `progress(file name, done, total)` is called
+    as the chunks of --cpu-workers or the audio of --batched are done."""
+    file = os.path.join(base, f'{name}.{video_ext}')
     print(name, "=======================")
-    model = subs_ai.create_model('guillaumekln/faster-whisper', {'model_size_or_path': 'large-v3', 'device': "cuda", "compute_type": "float16", "language": "ja", "suppress_blank": True, "vad_filter": True,
-                                                                 "vad_parameters":  {
-                                                                     "min_speech_duration_ms": 250,
-                                                                     "max_speech_duration_s": float("inf"),
-                                                                     "min_silence_duration_ms": 2000,
-                                                                     "speech_pad_ms": 400,
-                                                                 },
-                                                                 })  # ,
-    subs = subs_ai.transcribe(file, model)
-    subs.save(f'{base}\\{name}.jp.srt')
-
-
-for n in files:
-    transcribe(n)
+    model.transcribe(file, os.path.join(base, f'{name}.jp.srt'), progress)
+
+
+class ClientGone(Exception):
+    pass
+
+
+class LineSender(io.TextIOBase):
+    """Sends the output of a job line by line to the client of the worker."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = ''
+
+    def send(self, message):
+        try:
+            self.conn.send(message)
+        except OSError as e:
+            raise ClientGone(e)
+
+    def write(self, s):
+        # progress bars end their lines with \r
+        self.buffer += s.replace('\r', '\n')
+        *lines, self.buffer = self.buffer.split('\n')
+        for line in lines:
+            if line:
+                self.send(('log', line + '\n'))
+        return len(s)
+
+    def flush(self):
+        if self.buffer:
+            self.send(('log', self.buffer))
+            self.buffer = ''
+
+
+def key_path(port) -> str:
+    # the key of the resident worker (--serve) on `port`, so a restarted server can use it again
+    return os.path.join(os.path.expanduser('~'), '.kestrel', f'whisper-worker-{port}.key')
+
+
+def save_key(port, key: str):
+    path = key_path(port)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # only readable by this user, even if the file was there before
+    os.chmod(path, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key)
+
+
+def load_key(port):
+    try:
+        with open(key_path(port)) as f:
+            return bytes.fromhex(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def serve(port, options):
+    # the worker only accepts connections with this key, because requests are unpickled
+    key = os.environ.get('KESTREL_WORKER_KEY') or secrets.token_hex(32)
+    save_key(port, key)
+    model = load_model(**options)
+    # the server stops the worker with terminate()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve_model(port, model, bytes.fromhex(key))
+    finally:
+        if hasattr(model, 'close'):
+            model.close()
+
+
+def serve_model(port, model, authkey: bytes):
+    print(f"Whisper worker ready on 127.0.0.1:{port}", flush=True)
+    with Listener(('127.0.0.1', port), authkey=authkey) as listener:
+        # one file at a time, the other clients wait in the backlog
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"Rejected a connection: {e}", flush=True)
+                continue
+            with conn:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    continue
+                if request.get('ping'):
+                    conn.send(('pong', None))
+                    continue
+                out = LineSender(conn)
+                try:
+                    try:
+                        with redirect_stdout(out), redirect_stderr(out):
+                            for name in request['files']:
+                                transcribe_file(model, request['base'], name, request.get('video_ext', 'mp4'),
+                                                lambda desc, n, total: out.send(('progress', (desc, n, total))))
+                        result = ('done', None)
+                    except ClientGone:
+                        raise
+                    except Exception as e:
+                        result = ('error', f"{type(e).__name__}: {e}")
+                    out.flush()
+                    out.send(result)
+                except ClientGone as e:
+                    # the client went away, e.g. the server was restarted
+                    print(f"Lost the client: {e}", flush=True)
+
+
+def ping(port) -> bool:
+    authkey = load_key(port)
+    if authkey is None:
+        return False
+    try:
+        with Client(('127.0.0.1', port), authkey=authkey) as conn:
+            conn.send({'ping': True})
+            return conn.recv()[0] == 'pong'
+    except (OSError, EOFError, AuthenticationError):
+        # e.g. a worker started with another key
+        return False
+
+
+def start_worker(port, options=(), env=None, timeout=600) -> subprocess.Popen:
+    """Starts `python transcribe_subsai.py --serve` with the command line `options`
+    of the model, and waits until the model is loaded. The worker gets a new random key."""
+    key = secrets.token_hex(32)
+    save_key(port, key)
+    cmd = [sys.executable, '-u', os.path.abspath(__file__), '--serve', str(port), *options]
+    proc = subprocess.Popen(cmd, env=dict(os.environ if env is None else env, KESTREL_WORKER_KEY=key))
+    deadline = time.time() + timeout
+    while not ping(port):
+        if proc.poll() is not None:
+            raise RuntimeError(f"Whisper worker exited with code {proc.returncode}")
+        if time.time() > deadline:
+            proc.kill()
+            raise RuntimeError("Whisper worker did not start in time")
+        time.sleep(1)
+    return proc
+
+
+def request(port, base, files, video_ext='mp4', log=print, progress=None):
+    """Transcribes files in the resident worker, with its output going to `log`
+    and its progress to `progress(file name, done, total)`."""
+    authkey = load_key(port)
+    if authkey is None:
+        raise RuntimeError(f"No key for the whisper worker on port {port} in {key_path(port)}")
+    with Client(('127.0.0.1', port), authkey=authkey) as conn:
+        conn.send({'base': base, 'files': files, 'video_ext': video_ext})
+        while True:
+            kind, data = conn.recv()
+            if kind == 'log':
+                log(data)
+            elif kind == 'progress':
+                if progress is not None:
+                    progress(*data)
+            elif kind == 'error':
+                raise RuntimeError(data)
+            else:
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--base', type=str, default='D:\\Temp', help='视频文件所在目录')
+    parser.add_argument('--files', nargs='+', help='视频文件名列表（不带扩展名）')
+    parser.add_argument('--video_ext', type=str, default='mp4', help='视频扩展名')
+    parser.add_argument('--device', type=str, default='cuda', choices=['cuda', 'cpu'], help='运行模型的设备')
+    parser.add_argument('--compute-type', type=str, default=None, help='模型精度，默认 cuda 为 float16，cpu 为 int8')
+    parser.add_argument('--cpu-threads', type=int, default=0, help='每个模型使用的 CPU 线程数，0 为自动')
+    parser.add_argument('--num-workers', type=int, default=1, help='模型内部并行解码的数量')
+    parser.add_argument('--batched', action='store_true', help='按 VAD 切分音频，用 faster-whisper 的批量推理转录')
+    parser.add_argument('--batch-size', type=int, default=16, help='--batched 每批转录的音频段数')
+    parser.add_argument('--cpu-workers', type=int, default=0, help='按 VAD 切分音频，在这么多个 CPU 进程中并行转录')
+    parser.add_argument('--chunk-length', type=int, default=None, help='切分的音频段最长秒数，--batched 默认 30，--cpu-workers 默认 60')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='常驻模式：模型只加载一次，在本机端口上接收转录任务')
+    args = parser.parse_args()
+
+    options = dict(device=args.device, compute_type=args.compute_type, batched=args.batched, cpu_workers=args.cpu_workers,
+                   cpu_threads=args.cpu_threads, num_workers=args.num_workers, batch_size=args.batch_size, chunk_length=args.chunk_length)
+    if args.serve:
+        serve(args.serve, options)
+        return
+    if not args.files:
+        parser.error('--files is required unless --serve is given')
+    model = load_model(**options)
+    for n in args.files:
+        transcribe_file(model, args.base, n, args.video_ext)
+
+
+if __name__ == '__main__':
+    main()
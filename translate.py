@@ -8,39 +8,20 @@ from google import genai
 from google.genai import chats
 from google.genai import types
 import sys
-import tqdm
-import time
 import argparse
 import os
-
-# old_init = requests.Session.request
-# def newrequest()
-
-# requests.Session.request
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--key", type=str, required=True)
-parser.add_argument("--base", type=str, required=True)
-parser.add_argument('-l','--list', nargs='+', help='file names', default=[], required=True)
-parser.add_argument('--resume', type=int, default=0)
-parser.add_argument('--batchsize', type=int, default=200)
-parser.add_argument('--in-lang', type=str, default="jp")
-parser.add_argument('--out-lang', type=str, default="zh-cn")
-parser.add_argument('--hint', type=str, default="")
-
-args = parser.parse_args()
-
-base = args.base
-files = args.list
-resume = args.resume
-in_lang = args.in_lang
-out_lang = args.out_lang
-hint = args.hint
+import ratelimit
+import cache
+import srtfile
+import time
+import batching
+import translation_memory
+from concurrent.futures import ThreadPoolExecutor
 
 language_map = {"zh-cn" : "chinese", "jp" : "japanese", "ja" : "japanese", "en" : "english"}
-target_language = language_map.get(out_lang, out_lang)
 
-system_instruction = f'''Translate a subtitle file.
+def make_system_instruction(target_language: str, hint: str) -> str:
+  return f'''Translate a subtitle file.
 You only need to translate the contents of the file.
 Translate to {target_language}. Output "ENDENDEND" when you reach the end of the input
 The input will be like
@@ -56,7 +37,23 @@ For example, don't output "[[124::我的 早饭 是 饭团". Instead, output "[[
 {hint}
 '''
 
-def generation_config():
+def parse_translations(outtxt: str, content_slice) -> dict:
+  translated = {}
+  outstr = outtxt.split("[[")
+  for outline in outstr:
+    outline = outline.strip()
+    if not outline:
+      continue
+    spl = outline.split("::")
+    idx = int(spl[0])
+    con = spl[1]
+    if idx < content_slice[0][0] or idx > content_slice[-1][0]:
+      #print("Bad line", outline)
+      continue
+    translated[idx] = con.strip()
+  return translated
+
+def generation_config(system_instruction):
     return types.GenerateContentConfig(
         system_instruction = system_instruction,
         temperature = 1,
@@ -83,103 +80,211 @@ def generation_config():
             ]
         )
 
-client = genai.Client(api_key=args.key)
-chat = client.chats.create(
-            model="gemini-3-flash-lite-preview",
-            config=generation_config()
-        )
-print(base, files)
-
-for filename in files:
-  with open(os.path.join(base, f'{filename}.{in_lang}.srt'), encoding="utf-8-sig") as f:
-    lines = f.readlines()
-  print("GEN")
-  line_count = 0
-  contents=[]
-  for idx,l in enumerate(lines):
-    if " --> " in l:
-      line_count+=1
-      continue
-    l=l.strip()
-    if not l.isdigit() and len(l):
-      contents.append((idx, l))
-
-  outf = open(os.path.join(base, f'{filename}.{out_lang}.srt'), 'w' if resume == 0 else 'a', encoding="utf-8-sig")
-  if resume == 0:
-    progress = 0
-  else:
-    progress = lines.index(str(resume+1) + "\n")
-    if progress < 0:
-      raise RuntimeError("Cannot find resume point")
-  translated = lines[:]
-  bar = tqdm.tqdm(total=line_count)
-  batchsize = args.batchsize
-  bar.update(resume)
-  prompt_parts = []
-  # for start in range(resume, len(contents), batchsize):
-  start = resume
-  while start < len(contents):
-    prompt_parts = prompt_parts[-3*2:]
-    def make_promp():
-      content_slice = contents[start:start+batchsize]
-      promp = [f"[[{c[0]}::{c[1]}" for c in content_slice]
-      # print("range:", content_slice[0][0], content_slice[-1][0])
-      # print(promp)
-      prompt_parts.append(types.Content(role="user", parts=[types.Part.from_text(text="\n".join(promp))]))
-      return content_slice, promp
-    content_slice, promp = make_promp()
-    done = False
-    outtxt = ""
-    while not done:
-      for retries in range(6):
-        try:
-          response = client.models.generate_content(
-            model="gemini-3-flash-preview",
-            contents=prompt_parts
-          )
-          time.sleep(15)
-          break
-        except Exception as e:
-          if retries == 5:
-            raise e
-          print(f"Error!!!!!!!!!!!!!!{e}\\nsleeping")
-          is_internal_err = "An internal error has occurred." in str(e)
-          time.sleep(20 if is_internal_err else 60)
-          if 'Remote end closed connection without response' in str(e):
-            batchsize //= 2
-            if batchsize == 0:
-              batchsize = 1
-            prompt_parts.pop()
-            content_slice, promp = make_promp()
-            print("Retry with BS=", batchsize)
-      if True:
-        outtxt+=response.text
-        if "ENDENDEND" in outtxt or outtxt.count("[[") >= len(content_slice):
-          done = True
-          outtxt = outtxt.replace("ENDENDEND", "")
-      prompt_parts.append(response.candidates[0].content)
-      if done:
+class Translator:
+  """Translates SRT files with Gemini. One Translator may translate several
+  files at the same time; every file keeps its own conversation context, while
+  the rate limiter and the response cache are shared."""
+
+  def __init__(self, key: str, out_lang: str, hint: str, rpm: float = 5, tpm: float = 0, use_cache: bool = True,
+               max_tokens: int = 24000, target_latency: float = 120, stream: bool = False, in_lang: str = "jp",
+               memory: translation_memory.TranslationMemory = None, limiter: ratelimit.RateLimiter = None,
+               proxy: str = None, log=print, progress=None):
+    if proxy:
+      self.client = genai.Client(api_key=key, http_options=types.HttpOptions(client_args={"proxy": proxy}))
+    else:
+      self.client = genai.Client(api_key=key)
+    self.model = "gemini-3-flash-preview"
+    self.system_instruction = make_system_instruction(language_map.get(out_lang, out_lang), hint)
+    # translators using the same API key can share one limiter
+    self.limiter = limiter or ratelimit.RateLimiter(rpm, tpm)
+    self.response_cache = cache.ResponseCache() if use_cache else None
+    # estimated input + output tokens per request, and the slowest acceptable reply
+    self.max_tokens = max_tokens
+    self.target_latency = target_latency
+    # write the translated lines as they arrive instead of waiting for the whole reply
+    self.stream = stream
+    self.in_lang = in_lang
+    self.out_lang = out_lang
+    # lines translated before are filled in from the memory, if given
+    self.memory = memory
+    # messages, and progress(file name, cues written, total cues) instead of the progress bars
+    self.log = log
+    self.progress = progress
+
+  def prompt_tokens(self, prompt_parts) -> int:
+    return ratelimit.estimate_tokens(self.system_instruction + "".join(p.text for c in prompt_parts for p in c.parts if p.text))
+
+  def cache_key(self, prompt_parts):
+    contents = [(c.role, [p.text for p in c.parts]) for c in prompt_parts]
+    return self.response_cache.make_key(self.model, self.system_instruction, contents)
+
+  def translate_file(self, src_path: str, out_path: str, resume: int = -1, batchsize: int = 200, position: int = 0):
+    sizer = batching.BatchSizer(batchsize, self.max_tokens, target_latency=self.target_latency)
+    out = srtfile.TranslationOutput(src_path, out_path, resume, position, self.log, self.progress)
+    pending = translation_memory.PendingCues(out.cues, out.written, self.memory, self.in_lang, self.out_lang)
+    prompt_parts = []
+    while True:
+      prompt_parts = prompt_parts[-3*2:]
+      def make_promp():
+        pending.read(batchsize)
+        # the system instruction and the previous turns share the budget with the batch
+        content_slice, send, same = pending.batch(sizer.take(pending.texts(), self.prompt_tokens(prompt_parts)))
+        promp = [f"[[{c[0]}::{c[1].text}" for c in send]
+        # print("range:", content_slice[0][0], content_slice[-1][0])
+        # print(promp)
+        if promp:
+          prompt_parts.append(types.Content(role="user", parts=[types.Part.from_text(text="\n".join(promp))]))
+        return content_slice, promp, send, same
+      content_slice, promp, send, same = make_promp()
+      if not content_slice:
         break
-      prompt_parts.append(types.Content(role="user", parts=[types.Part.from_text(text="continue")]))
-    bar.update(len(promp))
-    # print(outtxt)
-    outstr = outtxt.split("[[")
-    for outline in outstr:
-      outline = outline.strip()
-      if not outline:
-        continue
-      spl = outline.split("::")
-      idx = int(spl[0])
-      con = spl[1]
-      if idx < content_slice[0][0] or idx > content_slice[-1][0]:
-        #print("Bad line", outline)
-        continue
-      translated[idx] = con + "\n"
-    end_idx = content_slice[-1][0]
-    for idx in range(progress, end_idx+1):
-      outf.write(translated[idx])
-    outf.flush()
-    progress = end_idx+1
-    start += batchsize
-  outf.flush()
-  outf.close()
\ No newline at end of file
+      sources = [(idx, cue.text) for idx, cue in send]
+      done = not promp
+      outtxt = ""
+      rounds = 0
+      latency = 0.0
+      # number of cues of the batch already written
+      written = 0
+      def write_translated(text, final=False):
+        # writes the cues whose translations are complete in `text`, in order. While
+        # streaming, the line after the last "[[" may still be growing
+        nonlocal written
+        if not final:
+          text = text[:max(text.rfind("[["), 0)]
+        received = parse_translations(text.replace("ENDENDEND", ""), content_slice)
+        translated = translation_memory.fill(received, pending.filled, same)
+        # only up to the first cue still missing: the model may skip or reorder lines,
+        # those are left to the final pass. Lines filled locally do not wait for the model
+        end = len(content_slice) if final else written
+        while end < len(content_slice) and content_slice[end][0] in translated:
+          end += 1
+        for idx, cue in content_slice[written:end]:
+          if idx in translated:
+            cue.text = translated[idx]
+          out.write(cue)
+        if end > written:
+          out.flush()
+          written = end
+        return translated
+      while not done:
+        rounds += 1
+        text = None if self.response_cache is None else self.response_cache.get(self.cache_key(prompt_parts))
+        cached = text is not None
+        est_tokens = self.prompt_tokens(prompt_parts)
+        for retries in range(0 if cached else 6):
+          try:
+            self.limiter.acquire(est_tokens)
+            call_start = time.monotonic()
+            if self.stream:
+              text = ""
+              response = None
+              for response in self.client.models.generate_content_stream(
+                model=self.model,
+                contents=prompt_parts
+              ):
+                text += response.text or ""
+                write_translated(outtxt + text)
+            else:
+              response = self.client.models.generate_content(
+                model=self.model,
+                contents=prompt_parts
+              )
+              text = response.text
+            latency += time.monotonic() - call_start
+            break
+          except Exception as e:
+            if retries == 5:
+              raise e
+            self.log(f"Error!!!!!!!!!!!!!!{e}\\nsleeping")
+            self.limiter.backoff(retries, e)
+            if self.stream and text:
+              # keep the lines received before the error and let the model continue after them
+              received = text[:max(text.rfind("[["), 0)]
+              text = None
+              if received.strip():
+                outtxt += received
+                prompt_parts.append(types.Content(role="model", parts=[types.Part.from_text(text=received)]))
+                prompt_parts.append(types.Content(role="user", parts=[types.Part.from_text(text="continue")]))
+                continue
+            if written == 0 and 'Remote end closed connection without response' in str(e):
+              sizer.shrink()
+              prompt_parts.pop()
+              content_slice, promp, send, same = make_promp()
+              sources = [(idx, cue.text) for idx, cue in send]
+              self.log(f"Retry with BS= {len(content_slice)}")
+              if not promp:
+                break
+        if not promp:
+          # every line of the smaller batch is known to the memory: nothing to ask
+          break
+        if not cached:
+          usage = getattr(response, "usage_metadata", None)
+          self.limiter.record_usage(est_tokens, getattr(usage, "total_token_count", None) or 0)
+          if self.response_cache is not None:
+            self.response_cache.put(self.cache_key(prompt_parts), text)
+        if True:
+          outtxt+=text
+          if "ENDENDEND" in outtxt or outtxt.count("[[") >= len(promp):
+            done = True
+            outtxt = outtxt.replace("ENDENDEND", "")
+        prompt_parts.append(types.Content(role="model", parts=[types.Part.from_text(text=text)]))
+        if done:
+          break
+        prompt_parts.append(types.Content(role="user", parts=[types.Part.from_text(text="continue")]))
+      if latency:
+        # a reply that needed "continue" was truncated: the batch was too large
+        sizer.observe(latency, rounds > 1, "\n".join(promp), outtxt)
+      # print(outtxt)
+      translated = write_translated(outtxt, final=True)
+      pending.done(content_slice, [(text, translated[idx]) for idx, text in sources if idx in translated])
+      pending.remove(content_slice)
+    out.finish()
+
+def translate_files(translator: Translator, base: str, files, in_lang: str, out_lang: str, resume: int = -1, batchsize: int = 200, jobs: int = 4):
+  # batches of different files are interleaved through the shared rate limiter
+  with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+    futures = [pool.submit(translator.translate_file, os.path.join(base, f'{filename}.{in_lang}.srt'),
+                           os.path.join(base, f'{filename}.{out_lang}.srt'), resume, batchsize, position)
+               for position, filename in enumerate(files)]
+    errors = []
+    for filename, fut in zip(files, futures):
+      try:
+        fut.result()
+      except Exception as e:
+        translator.log(f"Failed to translate {filename}: {e}")
+        errors.append(e)
+  if translator.response_cache is not None:
+    translator.log(translator.response_cache.stats())
+  if translator.memory is not None:
+    translator.log(translator.memory.stats())
+  if errors:
+    raise errors[0]
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--key", type=str, required=True)
+  parser.add_argument("--base", type=str, required=True)
+  parser.add_argument('-l','--list', nargs='+', help='file names', default=[], required=True)
+  parser.add_argument('--resume', type=int, default=-1, help="number of conversations already in the output file, -1 to detect it, 0 to start over")
+  parser.add_argument('--batchsize', type=int, default=200, help="max number of conversations per request")
+  parser.add_argument('--max-tokens', type=int, default=24000, help="max estimated input + output tokens per request")
+  parser.add_argument('--in-lang', type=str, default="jp")
+  parser.add_argument('--out-lang', type=str, default="zh-cn")
+  parser.add_argument('--hint', type=str, default="")
+  parser.add_argument('--rpm', type=float, default=5, help="requests per minute allowed by the API key, 0 for unlimited")
+  parser.add_argument('--tpm', type=float, default=0, help="tokens per minute allowed by the API key, 0 for unlimited")
+  parser.add_argument('--no-cache', action="store_true", default=False, help="do not reuse responses received by previous runs")
+  parser.add_argument('--jobs', type=int, default=4, help="number of files translated at the same time")
+  parser.add_argument('--stream-response', action="store_true", default=False, help="write the translations as they are generated")
+  parser.add_argument('--tm', action="store_true", default=False, help="fill in lines translated before from the translation memory")
+  parser.add_argument('--tm-fuzzy', type=float, default=0, help="with --tm, also reuse lines at least this similar (0~1, e.g. 0.9)")
+  args = parser.parse_args()
+
+  print(args.base, args.list)
+  memory = translation_memory.TranslationMemory(fuzzy=args.tm_fuzzy) if args.tm else None
+  translator = Translator(args.key, args.out_lang, args.hint, args.rpm, args.tpm, not args.no_cache, args.max_tokens, stream=args.stream_response,
+                          in_lang=args.in_lang, memory=memory)
+  translate_files(translator, args.base, args.list, args.in_lang, args.out_lang, args.resume, args.batchsize, args.jobs)
+
+if __name__ == "__main__":
+  main()
@@ -1,15 +1,22 @@
 """
 At the command line, only need to run once to install the package via pip:
 
-$ pip install google-generativeai
+$ pip install ollama openai pydantic
 """
 
 
-import tqdm
 import time
 import argparse
+import asyncio
+import collections
 import os
 import json
+import cache
+import srtfile
+import batching
+import ratelimit
+import endpoints
+import translation_memory
 from pydantic import BaseModel, TypeAdapter
 
 # old_init = requests.Session.request
@@ -17,59 +24,9 @@ from pydantic import BaseModel, TypeAdapter
 
 # requests.Session.request
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--base", type=str, required=True)
-parser.add_argument('-l','--list', nargs='+', help='file names', default=[], required=True)
-parser.add_argument('--resume', type=int, default=0)
-parser.add_argument('--batchsize', type=int, default=50)
-parser.add_argument('--in-lang', type=str, default="jp")
-parser.add_argument('--out-lang', type=str, default="zh-cn")
-parser.add_argument('--hint', type=str, default="")
-parser.add_argument('--model', type=str, default="gpt-oss:20b")
-# choice between openai or ollama
-parser.add_argument('--api', type=str, default="ollama")
-parser.add_argument('--context', type=str, default="")
-parser.add_argument('--window', type=int, default=3, help="number of previous translations to include in the prompt as context")
-
-
-args = parser.parse_args()
-
-base = args.base
-files = args.list
-resume = args.resume
-in_lang = args.in_lang
-out_lang = args.out_lang
-hint = args.hint
-context_window = args.window
-
 language_map = {"zh-cn" : "chinese", "jp" : "japanese", "ja" : "japanese", "en" : "english"}
-target_language = language_map.get(out_lang, out_lang)
-source_language = language_map.get(in_lang, in_lang)
-
-if args.api == "ollama":
-  import ollama
-  client = ollama.Client(host = "http://kun:11434")
-  def chat(messages):
-    response = client.chat(args.model, messages=messages, options={'think': False}, format=schema, think=False)
-    return response.message.content
-elif args.api == "openai":
-  from openai import OpenAI
-
-  client = OpenAI(
-      base_url='http://kun:8080/v1/',
-      api_key='ollama',  # required but ignored
-  )
-  def chat(messages):
-    completion = client.chat.completions.create(
-        model=args.model,
-        messages=messages,
-        extra_body = {"enable_thinking": False},
-        # Pass the Pydantic model to the response_format
-        response_format={"type": "json_object", "schema": schema} 
-    )
-    return completion.choices[0].message.content
-else:
-  raise ValueError("Unsupported API. Use --api to specify either 'ollama' or 'openai'.")
+
+default_endpoints = {"ollama": "http://kun:11434", "openai": "http://kun:8080/v1/"}
 
 class TranslatedMessage(BaseModel):
   id: int
@@ -86,14 +43,22 @@ def remove_think(data: str) -> str:
     data = data[data.find(think_tag) + len(think_tag):]
   return data.strip()
 
-if args.context:
-  with open(args.context, encoding="utf-8") as f:
-    custom_context = "关于内容的额外信息：\n" + f.read()
-else:
-  custom_context = ""
-print("Custom context:", custom_context[:25], "..." if len(custom_context) > 25 else "")
+def trim_history(history, max_tokens: int):
+  # keeps the latest translations that fit into max_tokens, cutting the oldest one kept if needed
+  kept = []
+  for text in reversed(history):
+    tokens = ratelimit.estimate_tokens(text)
+    if tokens > max_tokens:
+      keep = len(text) * max(max_tokens, 0) // tokens
+      if keep:
+        kept.append(text[-keep:])
+      break
+    kept.append(text)
+    max_tokens -= tokens
+  return kept[::-1]
 
-system_instruction = f'''Translate a subtitle. You only need to translate the contents.
+def make_system_instruction(target_language: str, source_language: str, hint: str, custom_context: str) -> str:
+  return f'''Translate a subtitle. You only need to translate the contents.
 Translate to {target_language}.
 The input will be in JSON format like below:
 [
@@ -118,94 +83,233 @@ The user will provide the context of the conversions. It is only for your refere
 Translate from {source_language} to {target_language}. Note that the output json schema is different from the input one.
 '''
 
-print(base, files)
-
-for filename in files:
-  with open(os.path.join(base, f'{filename}.{in_lang}.srt'), encoding="utf-8-sig") as f:
-    lines = f.readlines()
-  print("GEN")
-  line_count = 0
-  contents=[]
-  for idx,l in enumerate(lines):
-    if " --> " in l:
-      line_count+=1
-      continue
-    l=l.strip()
-    if not l.isdigit() and len(l):
-      contents.append((idx, l))
-
-  outf = open(os.path.join(base, f'{filename}.{out_lang}.srt'), 'w' if resume == 0 else 'a', encoding="utf-8-sig")
-  if resume == 0:
-    progress = 0
-  else:
-    progress = lines.index(str(resume+1) + "\n")
-    if progress < 0:
-      raise RuntimeError("Cannot find resume point")
-  translated = lines[:]
-  bar = tqdm.tqdm(total=line_count)
-  batchsize = args.batchsize
-  bar.update(resume)
-  system_prompt = [{'role': 'system', 'content': system_instruction}]
-  history = []
-  # for start in range(resume, len(contents), batchsize):
-  start = resume
-  while start < len(contents):
-    history = history[-context_window:]
-    prompt_parts = []
-    def make_promp():
-      content_slice = contents[start:start+batchsize]
-      request = [{"id": c[0], "content": c[1]} for c in content_slice]
-      request_json = json.dumps(request, ensure_ascii=False)
-      # promp = [f"[[{c[0]}::{c[1]}" for c in content_slice]
-      # print("range:", content_slice[0][0], content_slice[-1][0])
-      # print(promp)
-      history_str = ("history for reference: " + '\n'.join(history)) if history else ""
-      prompt_parts.append({"role":"user", "content": f"{history_str}\nTranslate this from {source_language} to {target_language}:\n{request_json}\nTranslate this to {target_language}。 翻译到中文"})
-      return content_slice, request
-    content_slice, promp = make_promp()
-    resp = dict()
-    while True:
-      # time.sleep(1)
-      data = chat(system_prompt + prompt_parts)
+class Translator:
+  """Translates SRT files with local models served by one or more Ollama or
+  OpenAI-compatible endpoints. Batches of a file are sent to the endpoints
+  concurrently: a batch is dispatched as soon as an endpoint has a free slot,
+  with the translations of the batches finished so far as its context, and
+  the results are written in order."""
+
+  def __init__(self, pool: endpoints.EndpointPool, model: str, in_lang: str, out_lang: str, hint: str = "",
+               custom_context: str = "", batchsize: int = 50, max_tokens: int = 6000, window: int = 3,
+               use_cache: bool = True, repair_retries: int = 2, memory: translation_memory.TranslationMemory = None,
+               log=print, progress=None):
+    self.pool = pool
+    self.model = model
+    self.source_language = language_map.get(in_lang, in_lang)
+    self.target_language = language_map.get(out_lang, out_lang)
+    self.system_instruction = make_system_instruction(self.target_language, self.source_language, hint, custom_context)
+    self.batchsize = batchsize
+    self.max_tokens = max_tokens
+    # number of previous translations to include in the prompt as context
+    self.window = window
+    self.repair_retries = repair_retries
+    self.response_cache = cache.ResponseCache() if use_cache else None
+    self.in_lang = in_lang
+    self.out_lang = out_lang
+    # lines translated before are filled in from the memory, if given
+    self.memory = memory
+    # messages, and progress(file name, cues written, total cues) instead of the progress bars
+    self.log = log
+    self.progress = progress
+
+  async def chat(self, endpoint: endpoints.Endpoint, messages, use_cache=True) -> str:
+    # use_cache=False asks the model again, and replaces the cached answer
+    if self.response_cache is None:
+      return await endpoint.chat(self.model, messages, schema)
+    key = self.response_cache.make_key(self.model, "", messages, {"api": endpoint.api, "schema": schema})
+    data = self.response_cache.get(key) if use_cache else None
+    if data is None:
+      data = await endpoint.chat(self.model, messages, schema)
+      self.response_cache.put(key, data)
+    return data
+
+  def make_prompt(self, content_slice, history):
+    request = [{"id": c[0], "content": c[1].text} for c in content_slice]
+    request_json = json.dumps(request, ensure_ascii=False)
+    history_str = ("history for reference: " + '\n'.join(history)) if history else ""
+    return {"role":"user", "content": f"{history_str}\nTranslate this from {self.source_language} to {self.target_language}:\n{request_json}\nTranslate this to {self.target_language}。 翻译到中文"}
+
+  async def translate_batch(self, endpoint: endpoints.Endpoint, content_slice, history, sizer: batching.BatchSizer):
+    """Translates one batch on `endpoint` and releases it. Returns the translations by id.
+
+    Ids missing from a reply (or all of them, if the reply is not valid JSON)
+    are asked again in a repair request of their own with the same history, at
+    most `repair_retries` times. Then they are split in halves and repaired
+    separately, and a single cue that still fails keeps its original text.
+    Every request is a fresh prompt, so its size never grows."""
+    if not content_slice:
+      # every line of the batch is known to the translation memory
+      await self.pool.release(endpoint)
+      return {}
+    system_prompt = [{'role': 'system', 'content': self.system_instruction}]
+    failures = 0
+    rounds = 0
+
+    async def ask(part, use_cache):
+      nonlocal endpoint, failures, rounds
+      message = self.make_prompt(part, history)
+      while True:
+        try:
+          data = await self.chat(endpoint, system_prompt + [message], use_cache)
+          break
+        except Exception as e:
+          # the endpoint is down or broken: retry the request on another one
+          if failures == 5:
+            raise e
+          failures += 1
+          self.log(f"Error!!!!!!!!!!!!!!{e}\\non {endpoint.url}, switching endpoint")
+          failed, endpoint = endpoint, None
+          await self.pool.release(failed, failed=True)
+          endpoint = await self.pool.acquire()
+      rounds += 1
       data = data.replace('"content": “', '"content": "')
-      # prompt_parts.append({'role': 'assistant', 'content': data})
       # data = remove_think(data)
       try:
         raw: list[TranslatedMessage] = TypeAdapter(list[TranslatedMessage]).validate_json(data)
-        # if len(resp.data) != len(promp):
-        for m in raw:
-          resp[m.id] = m.content
-        missing = []
-        for r in promp:
-          if r["id"] not in resp:
-            missing.append(r["id"])
-        if missing:
-          request = [{"id": c[0], "content": c[1]} for c in content_slice if c[0] in missing]
-          request_json = json.dumps(request, ensure_ascii=False)
-          prompt_parts[-1]={"role":"user", "content": request_json}
-          print("Missing:", missing, "Retrying...")
-          continue
-        history.append("\n".join([resp[p['id']] for p in promp]))
-        break
       except Exception as e:
-        print("Error:", e)
-        print("Response:", data)
-        print("Retrying...")
-        prompt_parts.append({"role":"user", "content":f"The previous output is not valid JSON format. error: {str(e)}"})
-        continue
-    bar.update(len(promp))
-    # print(outtxt)
-    for idx, con in resp.items():
-      con = con.strip()
-      if idx < content_slice[0][0] or idx > content_slice[-1][0]:
-        #print("Bad line", outline)
-        continue
-      translated[idx] = con + "\n"
-    end_idx = content_slice[-1][0]
-    for idx in range(progress, end_idx+1):
-      outf.write(translated[idx])
-    outf.flush()
-    progress = end_idx+1
-    start += batchsize
-  outf.flush()
-  outf.close()
\ No newline at end of file
+        self.log(f"Error: {e}")
+        self.log(f"Response: {data}")
+        return {}
+      ids = {c[0] for c in part}
+      return {m.id: m.content for m in raw if m.id in ids}
+
+    async def repair(part, resp):
+      for _ in range(self.repair_retries):
+        missing = [c for c in part if c[0] not in resp]
+        if not missing:
+          return
+        self.log(f"Missing: {[c[0] for c in missing]} Retrying...")
+        # retries must not be served the same cached (bad) answer again
+        resp.update(await ask(missing, use_cache=False))
+      missing = [c for c in part if c[0] not in resp]
+      if len(missing) > 1:
+        half = len(missing) // 2
+        await repair(missing[:half], resp)
+        await repair(missing[half:], resp)
+      elif missing:
+        self.log(f"Giving up on {missing[0][0]}, keeping the original text")
+
+    call_start = time.monotonic()
+    try:
+      resp = await ask(content_slice, use_cache=True)
+      await repair(content_slice, resp)
+    finally:
+      if endpoint is not None:
+        await self.pool.release(endpoint)
+    # missing ids and broken JSON mostly come from replies cut short: the batch was too large
+    sizer.observe(time.monotonic() - call_start, rounds > 1, "\n".join(c[1].text for c in content_slice),
+                  "\n".join(resp.get(c[0], c[1].text) for c in content_slice))
+    return resp
+
+  async def translate_file(self, src_path: str, out_path: str, resume: int = -1, position: int = 0):
+    out = srtfile.TranslationOutput(src_path, out_path, resume, position, self.log, self.progress)
+    pending = translation_memory.PendingCues(out.cues, out.written, self.memory, self.in_lang, self.out_lang)
+    sizer = batching.BatchSizer(self.batchsize, self.max_tokens)
+    # translations of the finished batches by batch number, the history of later batches
+    finished = {}
+    # batches in flight, in the order of the file: (batch number, content slice, lines sent, repeated lines, task)
+    inflight = collections.deque()
+    batch_no = 0
+
+    def write_finished():
+      while inflight and inflight[0][-1].done():
+        number, content_slice, send, same, task = inflight.popleft()
+        received = task.result()
+        resp = translation_memory.fill(received, pending.filled, same)
+        pending.done(content_slice, [(cue.text, received[idx]) for idx, cue in send if idx in received])
+        finished[number] = "\n".join(resp.get(idx, cue.text) for idx, cue in content_slice)
+        for idx, cue in content_slice:
+          if idx in resp:
+            cue.text = resp[idx].strip()
+          out.write(cue)
+        out.flush()
+
+    try:
+      while True:
+        endpoint = await self.pool.acquire()
+        write_finished()
+        # batches still in flight are left out of the history
+        oldest = batch_no - self.window - len(inflight)
+        for number in [n for n in finished if n < oldest]:
+          del finished[number]
+        # the history is bounded as well, so no prompt grows beyond the token budget
+        history = trim_history([finished[n] for n in sorted(finished)][-self.window:], self.max_tokens // 4)
+        pending.read(self.batchsize)
+        # the system prompt and the history share the context window with the batch
+        reserved = ratelimit.estimate_tokens(self.system_instruction + "\n".join(history))
+        content_slice, send, same = pending.batch(sizer.take(pending.texts(), reserved))
+        if not content_slice:
+          await self.pool.release(endpoint)
+          break
+        task = asyncio.create_task(self.translate_batch(endpoint, send, history, sizer))
+        inflight.append((batch_no, content_slice, send, same, task))
+        batch_no += 1
+        pending.remove(content_slice)
+      while inflight:
+        await asyncio.wait([inflight[0][-1]])
+        write_finished()
+      out.finish()
+    finally:
+      for *_, task in inflight:
+        task.cancel()
+      out.close()
+
+  async def translate_files(self, base: str, files, in_lang: str, out_lang: str, resume: int = -1):
+    await self.pool.start()
+    try:
+      for position, filename in enumerate(files):
+        self.log("GEN")
+        await self.translate_file(os.path.join(base, f'{filename}.{in_lang}.srt'),
+                                  os.path.join(base, f'{filename}.{out_lang}.srt'), resume, position)
+    finally:
+      await self.pool.close()
+    self.log(self.pool.stats())
+    if self.response_cache is not None:
+      self.log(self.response_cache.stats())
+    if self.memory is not None:
+      self.log(self.memory.stats())
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--base", type=str, required=True)
+  parser.add_argument('-l','--list', nargs='+', help='file names', default=[], required=True)
+  parser.add_argument('--resume', type=int, default=-1, help="number of conversations already in the output file, -1 to detect it, 0 to start over")
+  parser.add_argument('--batchsize', type=int, default=50, help="max number of conversations per request")
+  parser.add_argument('--max-tokens', type=int, default=6000, help="max estimated tokens of a request and its reply, should fit the context window of the model")
+  parser.add_argument('--in-lang', type=str, default="jp")
+  parser.add_argument('--out-lang', type=str, default="zh-cn")
+  parser.add_argument('--hint', type=str, default="")
+  parser.add_argument('--model', type=str, default="gpt-oss:20b")
+  # choice between openai or ollama
+  parser.add_argument('--api', type=str, default="ollama")
+  parser.add_argument('--endpoints', nargs='+', default=None, help="URLs of the servers, optionally as URL=N to serve N requests at a time")
+  parser.add_argument('--concurrency', type=int, default=1, help="requests served by each endpoint at the same time, unless given by URL=N")
+  parser.add_argument('--context', type=str, default="")
+  parser.add_argument('--window', type=int, default=3, help="number of previous translations to include in the prompt as context")
+  parser.add_argument('--no-cache', action="store_true", default=False, help="do not reuse responses received by previous runs")
+  parser.add_argument('--repair-retries', type=int, default=2, help="times to ask again for translations missing from a reply before splitting them up")
+  parser.add_argument('--tm', action="store_true", default=False, help="fill in lines translated before from the translation memory")
+  parser.add_argument('--tm-fuzzy', type=float, default=0, help="with --tm, also reuse lines at least this similar (0~1, e.g. 0.9)")
+  args = parser.parse_args()
+
+  if args.api not in default_endpoints:
+    raise ValueError("Unsupported API. Use --api to specify either 'ollama' or 'openai'.")
+  specs = args.endpoints or [default_endpoints[args.api]]
+  pool = endpoints.EndpointPool([endpoints.Endpoint(args.api, *endpoints.parse_endpoint(s, args.concurrency)) for s in specs])
+
+  if args.context:
+    with open(args.context, encoding="utf-8") as f:
+      custom_context = "关于内容的额外信息：\n" + f.read()
+  else:
+    custom_context = ""
+  print("Custom context:", custom_context[:25], "..." if len(custom_context) > 25 else "")
+
+  print(args.base, args.list)
+  translator = Translator(pool, args.model, args.in_lang, args.out_lang, args.hint, custom_context, args.batchsize,
+                          args.max_tokens, args.window, not args.no_cache, args.repair_retries,
+                          translation_memory.TranslationMemory(fuzzy=args.tm_fuzzy) if args.tm else None)
+  asyncio.run(translator.translate_files(args.base, args.list, args.in_lang, args.out_lang, args.resume))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,172 @@
+"""
+Translation memory shared by translate.py and translate_ollama.py, kept in
+~/.cache/kestrel/memory.db (see cache.cache_dir()).
+
+Subtitles repeat a lot: catchphrases, short answers, the lyrics of an opening
+song. Every translated line is remembered by its normalized text and language
+pair. Lines found in the memory are filled in locally, and a line repeated
+within a batch is sent to the model only once.
+"""
+
+import difflib
+import itertools
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import cache
+
+
+def normalize(text: str) -> str:
+    # full-width letters, half-width kana and runs of spaces do not make a line different
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class TranslationMemory:
+    # fuzzy matches of very short lines are mostly wrong, e.g. "はい" and "はいっ"
+    min_fuzzy_length = 6
+
+    def __init__(self, path: Optional[str] = None, fuzzy: float = 0):
+        # similarity ratio (0~1) needed for a fuzzy match, 0 for exact matches only
+        self.fuzzy = fuzzy
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+        # normalized source lines by language pair, loaded on the first fuzzy lookup
+        self.sources: Dict[Tuple[str, str], List[str]] = {}
+        self.conn = sqlite3.connect(path or os.path.join(cache.cache_dir(), "memory.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS memory (
+                src_lang TEXT NOT NULL,
+                dst_lang TEXT NOT NULL,
+                source TEXT NOT NULL,
+                target TEXT NOT NULL,
+                used REAL NOT NULL,
+                PRIMARY KEY (src_lang, dst_lang, source)
+            )""")
+
+    def fuzzy_match(self, src_lang: str, dst_lang: str, key: str) -> Optional[str]:
+        sources = self.sources.get((src_lang, dst_lang))
+        if sources is None:
+            rows = self.conn.execute("SELECT source FROM memory WHERE src_lang=? AND dst_lang=?", (src_lang, dst_lang)).fetchall()
+            sources = self.sources[(src_lang, dst_lang)] = [row[0] for row in rows]
+        match = difflib.get_close_matches(key, sources, n=1, cutoff=self.fuzzy)
+        return match[0] if match else None
+
+    def lookup(self, src_lang: str, dst_lang: str, text: str) -> Optional[str]:
+        key = normalize(text)
+        if not key:
+            return None
+        with self.lock:
+            row = self.conn.execute("SELECT target FROM memory WHERE src_lang=? AND dst_lang=? AND source=?",
+                                    (src_lang, dst_lang, key)).fetchone()
+            if row is not None:
+                self.hits += 1
+                return row[0]
+            if self.fuzzy and len(key) >= self.min_fuzzy_length:
+                match = self.fuzzy_match(src_lang, dst_lang, key)
+                if match is not None:
+                    self.fuzzy_hits += 1
+                    return self.conn.execute("SELECT target FROM memory WHERE src_lang=? AND dst_lang=? AND source=?",
+                                             (src_lang, dst_lang, match)).fetchone()[0]
+            self.misses += 1
+        return None
+
+    def store(self, src_lang: str, dst_lang: str, pairs: Iterable[Tuple[str, str]]):
+        # pairs of (source line, translation)
+        rows = [(src_lang, dst_lang, normalize(s), t.strip(), time.time()) for s, t in pairs]
+        rows = [r for r in rows if r[2] and r[3]]
+        with self.lock, self.conn:
+            sources = self.sources.get((src_lang, dst_lang))
+            if sources is not None:
+                for r in rows:
+                    if self.conn.execute("SELECT 1 FROM memory WHERE src_lang=? AND dst_lang=? AND source=?", r[:3]).fetchone() is None:
+                        sources.append(r[2])
+            self.conn.executemany("INSERT OR REPLACE INTO memory (src_lang, dst_lang, source, target, used) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def stats(self) -> str:
+        return f"Translation memory: {self.hits} exact hits, {self.fuzzy_hits} fuzzy hits, {self.misses} misses"
+
+    def close(self):
+        self.conn.close()
+
+
+class PendingCues:
+    """The cues read from a file but not translated yet, numbered from `start` in
+    the prompts. With a memory, the lines it knows are looked up as they are read
+    and kept in `filled` by id until their batch is done."""
+
+    def __init__(self, cues, start: int, memory: Optional[TranslationMemory] = None, src_lang: str = "", dst_lang: str = ""):
+        self.cues = cues
+        self.start = start
+        self.memory = memory
+        self.src_lang = src_lang
+        self.dst_lang = dst_lang
+        self.pending = []
+        self.filled: Dict[int, str] = {}
+
+    def read(self, count: int):
+        # reads cues until `count` are pending
+        for cue in itertools.islice(self.cues, max(count - len(self.pending), 0)):
+            idx = self.start + len(self.pending)
+            self.pending.append((idx, cue))
+            found = self.memory.lookup(self.src_lang, self.dst_lang, cue.text) if self.memory is not None else None
+            if found is not None:
+                self.filled[idx] = found
+
+    def texts(self) -> List[str]:
+        # what each pending cue adds to a prompt, for sizing the batch
+        return ["" if idx in self.filled else cue.text for idx, cue in self.pending]
+
+    def batch(self, n: int):
+        """Returns the next `n` pending cues, the ones of them to send and the
+        repeated ones (see split_batch). They stay pending until remove()."""
+        content_slice = self.pending[:n]
+        # only the lines unknown to the memory are sent, each of them once
+        send, same = split_batch(content_slice, self.filled) if self.memory is not None else (content_slice, {})
+        return content_slice, send, same
+
+    def remove(self, content_slice):
+        del self.pending[:len(content_slice)]
+        self.start += len(content_slice)
+
+    def done(self, content_slice, pairs: Iterable[Tuple[str, str]]):
+        # remembers the (source line, translation) pairs the model made for a batch
+        if self.memory is not None:
+            self.memory.store(self.src_lang, self.dst_lang, pairs)
+        for idx, _ in content_slice:
+            self.filled.pop(idx, None)
+
+
+def split_batch(content_slice, filled: Dict[int, str]):
+    """Returns the cues of a batch the model has to translate, with every distinct
+    line only once, and maps the ids of repeated lines to the id sent instead."""
+    send = []
+    same = {}
+    first = {}
+    for idx, cue in content_slice:
+        if idx in filled:
+            continue
+        key = normalize(cue.text)
+        if key in first:
+            same[idx] = first[key]
+        else:
+            first[key] = idx
+            send.append((idx, cue))
+    return send, same
+
+
+def fill(translated: Dict[int, str], filled: Dict[int, str], same: Dict[int, int]) -> Dict[int, str]:
+    # the translations of the model plus the lines known locally
+    result = dict(translated)
+    for idx, sent in same.items():
+        if sent in translated:
+            result[idx] = translated[sent]
+    result.update(filled)
+    return result